@@ -1,11 +1,12 @@
-from keras.models import Model, clone_model
-from keras.layers import Input, Conv2D, Dense, Reshape, Dot, Activation, Multiply
-from keras.optimizers import SGD
 import numpy as np
-import keras.backend as K
+
+from RLC.inference import NumpyModel
+from RLC.training import update_fixed_weights
 
 
 def policy_gradient_loss(Returns):
+    import keras.backend as K
+
     def modified_crossentropy(action, action_probs):
         cost = (K.categorical_crossentropy(action, action_probs, from_logits=False, axis=1) * Returns)
         return K.mean(cost)
@@ -15,7 +16,7 @@ def policy_gradient_loss(Returns):
 
 class Agent(object):
 
-    def __init__(self, gamma=0.5, network='linear', learning_rate=0.01, verbose=0):
+    def __init__(self, gamma=0.5, network='linear', learning_rate=0.01, verbose=0, tau=1):
         """
         Agent that plays the white pieces in capture chess
         Args:
@@ -25,11 +26,17 @@ class Agent(object):
                 'linear' or 'conv'
             learning_rate: float
                 Learning rate, ideally around 0.1
+            tau: float (0,1]
+                Update rate of the fixed model in fix_model. 1 copies the weights, smaller values make a soft
+                (Polyak) update.
         """
         self.gamma = gamma
         self.network = network
         self.learning_rate = learning_rate
         self.verbose = verbose
+        self.tau = tau
+        self.fixed_model = None
+        self.fixed_version = 0  # Incremented by fix_model
         self.init_network()
         self.weight_memory = []
         self.long_term_mean = []
@@ -49,13 +56,22 @@ class Agent(object):
 
     def fix_model(self):
         """
-        The fixed model is the model used for bootstrapping
+        The fixed model is the model used for bootstrapping. It is built once and then updated in place.
+        The fixed evaluator runs the forward pass of the fixed model in NumPy, for low latency action selection.
         Returns:
         """
-        optimizer = SGD(learning_rate=self.learning_rate, momentum=0.0, nesterov=False)
-        self.fixed_model = clone_model(self.model)
-        self.fixed_model.compile(optimizer=optimizer, loss='mse', metrics=['mae'])
-        self.fixed_model.set_weights(self.model.get_weights())
+        if self.fixed_model is None:
+            from keras.models import clone_model
+            from keras.optimizers import SGD
+
+            optimizer = SGD(learning_rate=self.learning_rate, momentum=0.0, nesterov=False)
+            self.fixed_model = clone_model(self.model)
+            self.fixed_model.compile(optimizer=optimizer, loss='mse', metrics=['mae'])
+            self.fixed_model.set_weights(self.model.get_weights())
+        else:
+            update_fixed_weights(self.fixed_model, self.model, tau=self.tau)
+        self.fixed_evaluator = NumpyModel(self.fixed_model)
+        self.fixed_version += 1
 
     def init_linear_network(self):
         """
@@ -63,6 +79,10 @@ class Agent(object):
         Returns:
 
         """
+        from keras.layers import Input, Dense, Reshape
+        from keras.models import Model
+        from keras.optimizers import SGD
+
         optimizer = SGD(learning_rate=self.learning_rate, momentum=0.0, nesterov=False)
         input_layer = Input(shape=(8, 8, 8), name='board_layer')
         reshape_input = Reshape((512,))(input_layer)
@@ -76,6 +96,10 @@ class Agent(object):
         Returns:
 
         """
+        from keras.layers import Input, Conv2D, Reshape, Dot
+        from keras.models import Model
+        from keras.optimizers import SGD
+
         optimizer = SGD(learning_rate=self.learning_rate, momentum=0.0, nesterov=False)
         input_layer = Input(shape=(8, 8, 8), name='board_layer')
         inter_layer_1 = Conv2D(1, (1, 1), data_format="channels_first")(input_layer)  # 1,8,8
@@ -93,6 +117,10 @@ class Agent(object):
         Returns:
 
         """
+        from keras.layers import Input, Conv2D, Reshape, Dot, Activation, Multiply
+        from keras.models import Model
+        from keras.optimizers import SGD
+
         optimizer = SGD(learning_rate=self.learning_rate, momentum=0.0, nesterov=False)
         input_layer = Input(shape=(8, 8, 8), name='board_layer')
         R = Input(shape=(1,), name='Rewards')
@@ -108,51 +136,39 @@ class Agent(object):
         self.model = Model(inputs=[input_layer, R, legal_moves], outputs=[legal_softmax_layer])
         self.model.compile(optimizer=optimizer, loss=policy_gradient_loss(R))
 
-    def network_update(self, minibatch):
+    def network_update(self, states, moves, rewards, new_states, episode_active):
         """
-        Update the Q-network using samples from the minibatch
+        Update the Q-network using a minibatch
         Args:
-            minibatch: list
-                The minibatch contains the states, moves, rewards and new states.
+            states: np.ndarray with shape (N, 8, 8, 8)
+            moves: np.ndarray with shape (N, 2) of the from and to squares of the moves
+            rewards: np.ndarray with shape (N,)
+            new_states: np.ndarray with shape (N, 8, 8, 8)
+            episode_active: np.ndarray with shape (N,), 0 if the move ended the episode
 
         Returns:
             td_errors: np.array
                 array of temporal difference errors
 
         """
-
-        # Prepare separate lists
-        states, moves, rewards, new_states = [], [], [], []
-        td_errors = []
-        episode_ends = []
-        for sample in minibatch:
-            states.append(sample[0])
-            moves.append(sample[1])
-            rewards.append(sample[2])
-            new_states.append(sample[3])
-
-            # Episode end detection
-            if np.array_equal(sample[3], sample[3] * 0):
-                episode_ends.append(0)
-            else:
-                episode_ends.append(1)
+        n_samples = len(states)
+        rows = np.arange(n_samples)
+        moves = np.asarray(moves)
 
         # The Q target
-        q_target = np.array(rewards) + np.array(episode_ends) * self.gamma * np.max(
-            self.fixed_model.predict(np.stack(new_states, axis=0)), axis=1)
+        q_target = np.asarray(rewards) + np.asarray(episode_active) * self.gamma * np.max(
+            self.fixed_model.predict(new_states), axis=1)
 
         # The Q value for the remaining actions
-        q_state = self.model.predict(np.stack(states, axis=0))  # batch x 64 x 64
+        q_state = np.reshape(self.model.predict(states), (n_samples, 64, 64))
 
         # Combine the Q target with the other Q values.
-        q_state = np.reshape(q_state, (len(minibatch), 64, 64))
-        for idx, move in enumerate(moves):
-            td_errors.append(q_state[idx, move[0], move[1]] - q_target[idx])
-            q_state[idx, move[0], move[1]] = q_target[idx]
-        q_state = np.reshape(q_state, (len(minibatch), 4096))
+        td_errors = q_state[rows, moves[:, 0], moves[:, 1]] - q_target
+        q_state[rows, moves[:, 0], moves[:, 1]] = q_target
+        q_state = np.reshape(q_state, (n_samples, 4096))
 
         # Perform a step of minibatch Gradient Descent.
-        self.model.fit(x=np.stack(states, axis=0), y=q_state, epochs=1, verbose=0)
+        self.model.fit(x=states, y=q_state, epochs=1, verbose=0)
 
         return td_errors
 
@@ -167,7 +183,7 @@ class Agent(object):
             action values
 
         """
-        return self.fixed_model.predict(state) + np.random.randn() * 1e-9
+        return self.fixed_evaluator.predict(state) + np.random.randn() * 1e-9
 
     def policy_gradient_update(self, states, actions, rewards, action_spaces, actor_critic=False):
         """
@@ -203,7 +219,7 @@ class Agent(object):
         self.weight_memory.append(self.model.get_weights())
         self.model.fit(x=[np.stack(states, axis=0),
                           train_returns,
-                          np.concatenate(action_spaces, axis=0)
+                          np.reshape(action_spaces, (n_steps, 4096))
                           ],
                        y=[np.stack(targets, axis=0)],
                        verbose=self.verbose
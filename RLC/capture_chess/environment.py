@@ -1,35 +1,27 @@
 import chess
 import numpy as np
 
-mapper = {}
-mapper["p"] = 0
-mapper["r"] = 1
-mapper["n"] = 2
-mapper["b"] = 3
-mapper["q"] = 4
-mapper["k"] = 5
-mapper["P"] = 0
-mapper["R"] = 1
-mapper["N"] = 2
-mapper["B"] = 3
-mapper["Q"] = 4
-mapper["K"] = 5
+from RLC.encoder import encode_board, get_legal_actions, project_legal_actions, get_material_balance, get_material_delta
 
 
 class Board(object):
 
-    def __init__(self, FEN=None):
+    def __init__(self, FEN=None, dtype=np.float64):
         """
         Chess Board Environment
         Args:
             FEN: str
                 Starting FEN notation, if None then start in the default chess position
+            dtype: numpy float dtype
+                dtype of the layer board, np.float32 halves its size
         """
         self.FEN = FEN
+        self.dtype = dtype
         self.board = chess.Board(self.FEN) if self.FEN else chess.Board()
         self.init_action_space()
-        self.layer_board = np.zeros(shape=(8, 8, 8))
+        self.layer_board = np.zeros(shape=(8, 8, 8), dtype=self.dtype)
         self.init_layer_board()
+        self.material = get_material_balance(self.board)
 
     def init_action_space(self):
         """
@@ -45,23 +37,7 @@ class Board(object):
         Returns:
 
         """
-        self.layer_board = np.zeros(shape=(8, 8, 8))
-        for i in range(64):
-            row = i // 8
-            col = i % 8
-            piece = self.board.piece_at(i)
-            if piece == None:
-                continue
-            elif piece.symbol().isupper():
-                sign = 1
-            else:
-                sign = -1
-            layer = mapper[piece.symbol()]
-            self.layer_board[layer, row, col] = sign
-        if self.board.turn:
-            self.layer_board[6, :, :] = 1 / self.board.fullmove_number
-        if self.board.can_claim_draw():
-            self.layer_board[7, :, :] = 1
+        self.layer_board = encode_board(self.board, layout='capture', dtype=self.dtype)
 
     def step(self, action):
         """
@@ -77,11 +53,13 @@ class Board(object):
                 Difference in material value after the move
         """
         piece_balance_before = self.get_material_value()
+        self.material += get_material_delta(self.board, action)
         self.board.push(action)
         self.init_layer_board()
         piece_balance_after = self.get_material_value()
         if self.board.result() == "*":
             opponent_move = self.get_random_action()
+            self.material += get_material_delta(self.board, opponent_move)
             self.board.push(opponent_move)
             self.init_layer_board()
             capture_reward = piece_balance_after - piece_balance_before
@@ -111,27 +89,33 @@ class Board(object):
         legal_moves = np.random.choice(legal_moves)
         return legal_moves
 
-    def project_legal_moves(self):
+    def get_legal_actions(self):
+        """
+        Get the legal actions in sparse form
+        Returns: tuple
+            action_ids: np.ndarray with the action id (from_square * 64 + to_square) of every legal move
+            moves: dict mapping action id to python chess move
+        """
+        return get_legal_actions(self.board)
+
+    def project_legal_moves(self, action_ids=None):
         """
         Create a mask of legal actions
+        Args:
+            action_ids: legal action ids from get_legal_actions, determined from the board if None
         Returns: np.ndarray with shape (64,64)
         """
-        self.action_space = np.zeros(shape=(64, 64))
-        moves = [[x.from_square, x.to_square] for x in self.board.generate_legal_moves()]
-        for move in moves:
-            self.action_space[move[0], move[1]] = 1
+        if action_ids is None:
+            action_ids, _ = self.get_legal_actions()
+        self.action_space = project_legal_actions(action_ids)
         return self.action_space
 
     def get_material_value(self):
         """
-        Sums up the material balance using Reinfield values
+        Material balance using Reinfield values, kept up to date incrementally by step
         Returns: The material balance on the board
         """
-        pawns = 1 * np.sum(self.layer_board[0, :, :])
-        rooks = 5 * np.sum(self.layer_board[1, :, :])
-        minor = 3 * np.sum(self.layer_board[2:4, :, :])
-        queen = 9 * np.sum(self.layer_board[4, :, :])
-        return pawns + rooks + minor + queen
+        return self.material
 
     def reset(self):
         """
@@ -141,4 +125,5 @@ class Board(object):
         """
         self.board = chess.Board(self.FEN) if self.FEN else chess.Board()
         self.init_layer_board()
+        self.material = get_material_balance(self.board)
         self.init_action_space()
@@ -2,26 +2,50 @@ from RLC.capture_chess.agent import Agent
 from RLC.capture_chess.environment import Board
 import numpy as np
 from chess.pgn import Game
-import pandas as pd
+from RLC.encoder import action_from_square, action_to_square
+from RLC.replay import EpisodeReplayMemory, frame_capacity
+
+
+transition_columns = {'move_from': np.int64, 'move_to': np.int64, 'reward': np.float64, 'episode_active': np.int8}
+
+
+def get_minibatch(memory, indices):
+    """
+    Gather transitions from memory as arrays that can be fed to the networks
+    Args:
+        memory: RLC.replay.ReplayMemory with the transition_columns
+        indices: np.ndarray of sample indices
+
+    Returns: dict
+        states and new_states with shape (N, 8, 8, 8), moves with shape (N, 2), rewards and episode_active with
+        shape (N,)
+    """
+    states, new_states = memory.get_state_columns(('state', 'sucstate'), indices)
+    return {'states': states,
+            'moves': np.stack([memory['move_from'][indices], memory['move_to'][indices]], axis=1),
+            'rewards': memory['reward'][indices],
+            'new_states': new_states,
+            'episode_active': memory['episode_active'][indices]}
 
 
 class Q_learning(object):
 
-    def __init__(self, agent, env, memsize=1000):
+    def __init__(self, agent, env, memsize=1000, state_dtype=np.int8):
         """
         Reinforce object to learn capture chess
         Args:
             agent: The agent playing the chess game as white
             env: The environment including the python-chess board
-            memsize: maximum amount of games to retain in-memory
+            memsize: maximum amount of transitions to retain in-memory
+            state_dtype: storage dtype of the states in memory. np.int8 stores compact states of 400 bytes.
         """
         self.agent = agent
         self.env = env
-        self.memory = []
         self.memsize = memsize
+        self.state_dtype = state_dtype
         self.reward_trace = []
-        self.memory = []
-        self.sampling_probs = []
+        self.memory = EpisodeReplayMemory(memsize, columns=transition_columns, state_dtype=state_dtype,
+                                          frame_capacity=frame_capacity(memsize))
 
     def learn(self, iters=100, c=10):
         """
@@ -45,6 +69,7 @@ class Q_learning(object):
             self.play_game(k, greedy=greedy)
 
         pgn = Game.from_board(self.env.board)
+        import pandas as pd  # Deferred, only needed for plotting
         reward_smooth = pd.DataFrame(self.reward_trace)
         reward_smooth.rolling(window=10, min_periods=0).mean().plot()
 
@@ -80,76 +105,59 @@ class Q_learning(object):
                 move_to = move.to_square
             else:
                 action_values = self.agent.get_action_values(np.expand_dims(state, axis=0))
-                action_values = np.reshape(np.squeeze(action_values), (64, 64))
-                action_space = self.env.project_legal_moves()  # The environment determines which moves are legal
-                action_values = np.multiply(action_values, action_space)
-                move_from = np.argmax(action_values, axis=None) // 64
-                move_to = np.argmax(action_values, axis=None) % 64
-                moves = [x for x in self.env.board.generate_legal_moves() if \
-                         x.from_square == move_from and x.to_square == move_to]
-                if len(moves) == 0:  # If all legal moves have negative action value, explore.
+                # The environment determines which moves are legal
+                action_ids, legal_moves = self.env.get_legal_actions()
+                legal_action_values = np.squeeze(action_values)[action_ids]
+                action_id = action_ids[np.argmax(legal_action_values)]
+                if np.max(legal_action_values) < 0:  # If all legal moves have negative action value, explore.
                     move = self.env.get_random_action()
                     move_from = move.from_square
                     move_to = move.to_square
                 else:
-                    move = np.random.choice(moves)  # If there are multiple max-moves, pick a random one.
+                    move = legal_moves[action_id]
+                    move_from = action_from_square[action_id]
+                    move_to = action_to_square[action_id]
 
             episode_end, reward = self.env.step(move)
             new_state = self.env.layer_board
-            if len(self.memory) > self.memsize:
-                self.memory.pop(0)
-                self.sampling_probs.pop(0)
             turncount += 1
             if turncount > maxiter:
                 episode_end = True
                 reward = 0
-            if episode_end:
-                new_state = new_state * 0
-            self.memory.append([state, (move_from, move_to), reward, new_state])
-            self.sampling_probs.append(1)
+            self.memory.add(state=state, move_from=move_from, move_to=move_to, reward=reward, sucstate=new_state,
+                            episode_active=0 if episode_end else 1)
 
             self.reward_trace.append(reward)
 
-            self.update_agent(turncount)
+            self.update_agent()
+
+        self.memory.end_episode()
 
         return self.env.board
 
-    def sample_memory(self, turncount):
+    def sample_memory(self):
         """
-        Get a sample from memory for experience replay
-        Args:
-            turncount: int
-                turncount limits the size of the minibatch
+        Get a sample from memory for experience replay. Transitions of the running game are not sampled.
 
         Returns: tuple
-            a mini-batch of experiences (list)
+            a mini-batch of experiences (dict of arrays, see get_minibatch)
             indices of chosen experiences
 
         """
-        minibatch = []
-        memory = self.memory[:-turncount]
-        probs = self.sampling_probs[:-turncount]
-        sample_probs = [probs[n] / np.sum(probs) for n in range(len(probs))]
-        indices = np.random.choice(range(len(memory)), min(1028, len(memory)), replace=True, p=sample_probs)
-        for i in indices:
-            minibatch.append(memory[i])
-
-        return minibatch, indices
+        indices, _ = self.memory.sample(min(1028, self.memory.n_available()))
+        return get_minibatch(self.memory, indices), indices
 
-    def update_agent(self, turncount):
+    def update_agent(self):
         """
         Update the agent using experience replay. Set the sampling probs with the td error
-        Args:
-            turncount: int
-                Amount of turns played. Only sample the memory of there are sufficient samples
         Returns:
 
         """
-        if turncount < len(self.memory):
-            minibatch, indices = self.sample_memory(turncount)
-            td_errors = self.agent.network_update(minibatch)
-            for n, i in enumerate(indices):
-                self.sampling_probs[i] = np.abs(td_errors[n])
+        if self.memory.n_available() > 0:
+            minibatch, indices = self.sample_memory()
+            td_errors = self.agent.network_update(minibatch['states'], minibatch['moves'], minibatch['rewards'],
+                                                  minibatch['new_states'], minibatch['episode_active'])
+            self.memory.update_priorities(indices, td_errors)
 
 
 class Reinforce(object):
@@ -186,6 +194,7 @@ class Reinforce(object):
             self.reinforce_agent(states, actions, rewards, action_spaces)
 
         pgn = Game.from_board(self.env.board)
+        import pandas as pd  # Deferred, only needed for plotting
         reward_smooth = pd.DataFrame(self.reward_trace)
         reward_smooth.rolling(window=10, min_periods=0).mean().plot()
 
@@ -216,22 +225,17 @@ class Reinforce(object):
         # Play a game of chess
         while not episode_end:
             state = self.env.layer_board
-            action_space = self.env.project_legal_moves()  # The environment determines which moves are legal
+            action_ids, legal_moves = self.env.get_legal_actions()  # The environment determines which moves are legal
+            action_space = self.env.project_legal_moves(action_ids)
             action_probs = self.agent.model.predict([np.expand_dims(state, axis=0),
                                                      np.zeros((1, 1)),
                                                      action_space.reshape(1, 4096)])
             self.action_value_mem.append(action_probs)
             action_probs = action_probs / action_probs.sum()
-            move = np.random.choice(range(4096), p=np.squeeze(action_probs))
-            move_from = move // 64
-            move_to = move % 64
-            moves = [x for x in self.env.board.generate_legal_moves() if \
-                     x.from_square == move_from and x.to_square == move_to]
-            assert len(moves) > 0  # should not be possible
-            if len(moves) > 1:
-                move = np.random.choice(moves)  # If there are multiple max-moves, pick a random one.
-            elif len(moves) == 1:
-                move = moves[0]
+            action_id = np.random.choice(range(4096), p=np.squeeze(action_probs))
+            move_from = action_from_square[action_id]
+            move_to = action_to_square[action_id]
+            move = legal_moves[action_id]
 
             episode_end, reward = self.env.step(move)
             new_state = self.env.layer_board
@@ -265,22 +269,26 @@ class Reinforce(object):
 
 class ActorCritic(object):
 
-    def __init__(self, actor, critic, env):
+    def __init__(self, actor, critic, env, memsize=1000, state_dtype=np.int8):
         """
         ActorCritic object to learn capture chess
         Args:
             actor: Policy Gradient Agent
             critic: Q-learning Agent
             env: The environment including the python-chess board
-            memsize: maximum amount of games to retain in-memory
+            memsize: maximum amount of transitions to retain in-memory
+            state_dtype: storage dtype of the states in memory. np.int8 stores compact states of 400 bytes.
         """
         self.actor = actor
         self.critic = critic
         self.env = env
+        self.memsize = memsize
+        self.state_dtype = state_dtype
         self.reward_trace = []
         self.action_value_mem = []
-        self.memory = []
-        self.sampling_probs = []
+        columns = dict(transition_columns, legal_moves=(np.bool_, (4096,)))
+        self.memory = EpisodeReplayMemory(memsize, columns=columns, state_dtype=state_dtype,
+                                          frame_capacity=frame_capacity(memsize))
 
     def learn(self, iters=100, c=10):
         """
@@ -302,6 +310,7 @@ class ActorCritic(object):
             end_state = self.play_game(k)
 
         pgn = Game.from_board(self.env.board)
+        import pandas as pd  # Deferred, only needed for plotting
         reward_smooth = pd.DataFrame(self.reward_trace)
         reward_smooth.rolling(window=10, min_periods=0).mean().plot()
 
@@ -328,7 +337,8 @@ class ActorCritic(object):
         state = self.env.layer_board
         while not episode_end:
             state = self.env.layer_board
-            action_space = self.env.project_legal_moves()  # The environment determines which moves are legal
+            action_ids, legal_moves = self.env.get_legal_actions()  # The environment determines which moves are legal
+            action_space = self.env.project_legal_moves(action_ids)
             action_probs = self.actor.model.predict([np.expand_dims(state, axis=0),
                                                      np.zeros((1, 1)),
                                                      action_space.reshape(1, 4096)])
@@ -336,16 +346,10 @@ class ActorCritic(object):
             # print(action_probs)
             # print(np.max(action_probs))
             action_probs = action_probs / action_probs.sum()
-            move = np.random.choice(range(4096), p=np.squeeze(action_probs))
-            move_from = move // 64
-            move_to = move % 64
-            moves = [x for x in self.env.board.generate_legal_moves() if \
-                     x.from_square == move_from and x.to_square == move_to]
-            assert len(moves) > 0  # should not be possible
-            if len(moves) > 1:
-                move = np.random.choice(moves)  # If there are multiple max-moves, pick a random one.
-            elif len(moves) == 1:
-                move = moves[0]
+            action_id = np.random.choice(range(4096), p=np.squeeze(action_probs))
+            move_from = action_from_square[action_id]
+            move_to = action_to_square[action_id]
+            move = legal_moves[action_id]
 
             episode_end, reward = self.env.step(move)
             new_state = self.env.layer_board
@@ -353,74 +357,58 @@ class ActorCritic(object):
             if turncount > maxiter:
                 episode_end = True
                 reward = 0
-            if episode_end:
-                new_state = new_state * 0
 
-            self.memory.append([state, (move_from, move_to), reward, new_state, action_space.reshape(1, 4096)])
-            self.sampling_probs.append(1)
+            self.memory.add(state=state, move_from=move_from, move_to=move_to, reward=reward, sucstate=new_state,
+                            episode_active=0 if episode_end else 1, legal_moves=action_space.reshape(4096))
             self.reward_trace.append(reward)
 
-        self.update_actorcritic(turncount)
+        self.update_actorcritic()
+        self.memory.end_episode()
 
         return self.env.board
 
-    def sample_memory(self, turncount):
+    def sample_memory(self):
         """
-        Get a sample from memory for experience replay
-        Args:
-            turncount: int
-                turncount limits the size of the minibatch
+        Get a sample from memory for experience replay. Transitions of the running game are not sampled.
 
         Returns: tuple
-            a mini-batch of experiences (list)
+            a mini-batch of experiences (dict of arrays, see get_minibatch)
             indices of chosen experiences
 
         """
-        minibatch = []
-        memory = self.memory[:-turncount]
-        probs = self.sampling_probs[:-turncount]
-        sample_probs = [probs[n] / np.sum(probs) for n in range(len(probs))]
-        indices = np.random.choice(range(len(memory)), min(1028, len(memory)), replace=False, p=sample_probs)
-        for i in indices:
-            minibatch.append(memory[i])
-
-        return minibatch, indices
+        indices, _ = self.memory.sample(min(1028, self.memory.n_available()))
+        return get_minibatch(self.memory, indices), indices
 
-    def update_actorcritic(self, turncount):
+    def update_actorcritic(self):
         """Actor critic"""
 
-        if turncount < len(self.memory):
+        if self.memory.n_available() > 0:
 
             # Get a sampple
-            minibatch, indices = self.sample_memory(turncount)
+            minibatch, indices = self.sample_memory()
 
             # Update critic and find td errors for prioritized experience replay
-            td_errors = self.critic.network_update(minibatch)
+            td_errors = self.critic.network_update(minibatch['states'], minibatch['moves'], minibatch['rewards'],
+                                                   minibatch['new_states'], minibatch['episode_active'])
 
             # Get a Q value from the critic
-            states = [x[0] for x in minibatch]
-            actions = [x[1] for x in minibatch]
-            Q_est = self.critic.get_action_values(np.stack(states, axis=0))
-            action_spaces = [x[4] for x in minibatch]
+            Q_est = self.critic.get_action_values(minibatch['states'])
+            action_spaces = self.memory['legal_moves'][indices].astype(np.float32)
 
-            self.actor.policy_gradient_update(states, actions, Q_est, action_spaces, actor_critic=True)
+            self.actor.policy_gradient_update(minibatch['states'], minibatch['moves'], Q_est, action_spaces,
+                                              actor_critic=True)
 
             # Update sampling probs
-            for n, i in enumerate(indices):
-                self.sampling_probs[i] = np.abs(td_errors[n])
+            self.memory.update_priorities(indices, td_errors)
 
-    def update_critic(self, turncount):
+    def update_critic(self):
         """
         Update the agent using experience replay. Set the sampling probs with the td error
-        Args:
-            turncount: int
-                Amount of turns played. Only sample the memory of there are sufficient samples
         Returns:
 
         """
-        if turncount < len(self.memory):
-            minibatch, indices = self.sample_memory(turncount)
-            td_errors = self.critic.network_update(minibatch)
-
-            for n, i in enumerate(indices):
-                self.sampling_probs[i] = np.abs(td_errors[n])
+        if self.memory.n_available() > 0:
+            minibatch, indices = self.sample_memory()
+            td_errors = self.critic.network_update(minibatch['states'], minibatch['moves'], minibatch['rewards'],
+                                                   minibatch['new_states'], minibatch['episode_active'])
+            self.memory.update_priorities(indices, td_errors)
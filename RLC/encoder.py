@@ -0,0 +1,276 @@
+import chess
+import chess.polyglot
+import numpy as np
+
+mapper = {}
+mapper["p"] = 0
+mapper["r"] = 1
+mapper["n"] = 2
+mapper["b"] = 3
+mapper["q"] = 4
+mapper["k"] = 5
+mapper["P"] = 0
+mapper["R"] = 1
+mapper["N"] = 2
+mapper["B"] = 3
+mapper["Q"] = 4
+mapper["K"] = 5
+
+piece_layer = {}
+piece_layer[chess.PAWN] = 0
+piece_layer[chess.ROOK] = 1
+piece_layer[chess.KNIGHT] = 2
+piece_layer[chess.BISHOP] = 3
+piece_layer[chess.QUEEN] = 4
+piece_layer[chess.KING] = 5
+
+piece_values = {}
+piece_values[chess.PAWN] = 1
+piece_values[chess.ROOK] = 5
+piece_values[chess.KNIGHT] = 3
+piece_values[chess.BISHOP] = 3
+piece_values[chess.QUEEN] = 9
+piece_values[chess.KING] = 0
+
+material_values = np.array([1, 5, 3, 3, 9, 0])  # Reinfield values of the piece layers
+
+# Action ids index the 64 x 64 (from square, to square) action space of the networks.
+# All promotions of a pawn share one action id, which maps back to the queen promotion.
+action_from_square = np.repeat(np.arange(64), 64)
+action_to_square = np.tile(np.arange(64), 64)
+
+# Compact storage of a layer board: int8 piece layers and the two meta layers as scalars.
+# The meta layers are constant apart from their first row, so row 0 and row 1 describe them completely.
+compact_state = np.dtype([('pieces', np.int8, (6, 8, 8)), ('meta', np.float32, (2, 2))])
+
+
+def get_bitboards(board):
+    """
+    Get the piece bitboards of a board in layer order
+    Args:
+        board: python chess board
+
+    Returns: list of 12 integers
+        white pawns, rooks, knights, bishops, queens, king followed by the black pieces in the same order
+    """
+    white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+    masks = (board.pawns, board.rooks, board.knights, board.bishops, board.queens, board.kings)
+    return [mask & white for mask in masks] + [mask & black for mask in masks]
+
+
+def unpack_piece_layers(bitboards):
+    """
+    Turn piece bitboards into signed piece layers
+    Args:
+        bitboards: array-like of unsigned 64 bit integers with shape (N, 12)
+
+    Returns: np.ndarray with shape (N, 6, 8, 8) and dtype int8
+        +1 for white pieces, -1 for black pieces. Square i is found at [i // 8, i % 8].
+    """
+    bitboards = np.asarray(bitboards, dtype='<u8')
+    n = bitboards.shape[0]
+    bits = np.unpackbits(bitboards.view(np.uint8), axis=1, bitorder='little').view(np.int8)
+    bits = bits.reshape(n, 2, 6, 8, 8)
+    return bits[:, 0] - bits[:, 1]
+
+
+def set_meta_layers(layer_boards, boards, layout='real'):
+    """
+    Fill the move number, turn and draw layers of encoded boards
+    Args:
+        layer_boards: np.ndarray with shape (N, 8, 8, 8)
+        boards: list of N python chess boards
+        layout: str
+            'real' for the real chess environment, 'capture' for the capture chess environment
+
+    Returns:
+
+    """
+    if layout == 'real':
+        fullmove_numbers = np.array([board.fullmove_number for board in boards], dtype=np.float64)
+        turns = np.array([1 if board.turn else -1 for board in boards], dtype=np.float64)
+        layer_boards[:, 6, :, :] = (1 / fullmove_numbers)[:, None, None]
+        layer_boards[:, 6, 0, :] = turns[:, None]
+        layer_boards[:, 7, :, :] = 1
+    elif layout == 'capture':
+        for layer_board, board in zip(layer_boards, boards):
+            layer_board[6, :, :] = 1 / board.fullmove_number if board.turn else 0
+            layer_board[7, :, :] = 1 if board.can_claim_draw() else 0
+    else:
+        raise ValueError("Unknown layout " + str(layout))
+
+
+def encode_boards(boards, layout='real', dtype=np.float64):
+    """
+    Encode a batch of boards into their numerical representation in one call
+    Args:
+        boards: list of python chess boards
+        layout: str
+            'real' for the real chess environment, 'capture' for the capture chess environment
+        dtype: numpy dtype of the encoded boards
+
+    Returns: np.ndarray with shape (N, 8, 8, 8)
+
+    """
+    bitboards = [get_bitboards(board) for board in boards]
+    layer_boards = np.zeros(shape=(len(boards), 8, 8, 8), dtype=dtype)
+    if boards:
+        layer_boards[:, :6] = unpack_piece_layers(bitboards)
+        set_meta_layers(layer_boards, boards, layout=layout)
+    return layer_boards
+
+
+def encode_board(board, layout='real', dtype=np.float64):
+    """
+    Encode a single board into its numerical representation
+    Args:
+        board: python chess board
+        layout: str
+            'real' for the real chess environment, 'capture' for the capture chess environment
+        dtype: numpy dtype of the encoded board
+
+    Returns: np.ndarray with shape (8, 8, 8)
+
+    """
+    return encode_boards([board], layout=layout, dtype=dtype)[0]
+
+
+def get_position_key(board):
+    """
+    Cache key of a board position
+    Args:
+        board: python chess board
+
+    Returns: tuple
+        the Zobrist hash and the fullmove number, because the layer board also encodes the move number
+    """
+    return chess.polyglot.zobrist_hash(board), board.fullmove_number
+
+
+def get_material_balance(board):
+    """
+    Sums up the material balance of a board using Reinfield values
+    Args:
+        board: python chess board
+
+    Returns: int
+        material of white minus material of black
+    """
+    balance = 0
+    for piece_type, value in piece_values.items():
+        balance += value * (len(board.pieces(piece_type, chess.WHITE)) - len(board.pieces(piece_type, chess.BLACK)))
+    return balance
+
+
+def get_material_delta(board, move):
+    """
+    Change of the material balance by a move, without playing it
+    Args:
+        board: python chess board
+        move: python chess move, legal on the board
+
+    Returns: int
+        material balance after the move minus the material balance before the move
+    """
+    delta = 0
+    if board.is_en_passant(move):
+        delta += piece_values[chess.PAWN]
+    elif not board.is_castling(move):
+        captured = board.piece_type_at(move.to_square)
+        if captured:
+            delta += piece_values[captured]
+    if move.promotion:
+        delta += piece_values[move.promotion] - piece_values[chess.PAWN]
+    return delta if board.turn else -delta
+
+
+def pack_states(states, dtype=np.int8):
+    """
+    Convert layer boards to their storage format
+    Args:
+        states: np.ndarray with shape (N, 8, 8, 8)
+        dtype: storage dtype. np.int8 stores compact_state records of 400 bytes, float dtypes store plain layer boards
+
+    Returns: np.ndarray
+        shape (N,) with dtype compact_state for np.int8, otherwise shape (N, 8, 8, 8)
+    """
+    states = np.asarray(states)
+    if np.dtype(dtype) != np.int8:
+        return states.astype(dtype)
+    packed = np.zeros(shape=states.shape[0], dtype=compact_state)
+    packed['pieces'] = states[:, :6]
+    packed['meta'] = states[:, 6:, :2, 0]
+    return packed
+
+
+def unpack_states(packed, dtype=np.float32):
+    """
+    Convert stored layer boards back to the format that the models consume
+    Args:
+        packed: np.ndarray returned by pack_states
+        dtype: dtype of the returned layer boards
+
+    Returns: np.ndarray with shape (N, 8, 8, 8)
+    """
+    if packed.dtype != compact_state:
+        return packed.astype(dtype, copy=False)
+    states = np.empty(shape=(packed.shape[0], 8, 8, 8), dtype=dtype)
+    states[:, :6] = packed['pieces']
+    states[:, 6:, 1:, :] = packed['meta'][:, :, 1, None, None]
+    states[:, 6:, 0, :] = packed['meta'][:, :, 0, None]
+    return states
+
+
+def get_legal_actions(board):
+    """
+    Get the legal actions of a board in sparse form
+    Args:
+        board: python chess board
+
+    Returns: tuple
+        action_ids: np.ndarray with the action id of every legal move
+        moves: dict mapping action id to python chess move
+    """
+    moves = {}
+    for move in board.generate_legal_moves():
+        action = move.from_square * 64 + move.to_square
+        if action not in moves or move.promotion == chess.QUEEN:
+            moves[action] = move
+    return np.fromiter(moves.keys(), dtype=np.int64, count=len(moves)), moves
+
+
+def get_legal_actions_batch(boards):
+    """
+    Get the legal actions of a batch of boards in sparse (coordinate) form
+    Args:
+        boards: list of python chess boards
+
+    Returns: tuple
+        board_ids: np.ndarray with the index of the board of every legal action
+        action_ids: np.ndarray with the action id of every legal action
+        moves: list with a dict mapping action id to python chess move for every board
+    """
+    legal_actions = [get_legal_actions(board) for board in boards]
+    board_ids = np.repeat(np.arange(len(boards)), [len(action_ids) for action_ids, _ in legal_actions])
+    action_ids = np.concatenate([action_ids for action_ids, _ in legal_actions] + [np.zeros(0, dtype=np.int64)])
+    return board_ids, action_ids, [moves for _, moves in legal_actions]
+
+
+def project_legal_actions(action_ids, board_ids=None, n_boards=1):
+    """
+    Create a dense mask of legal actions from sparse action ids
+    Args:
+        action_ids: np.ndarray of action ids
+        board_ids: np.ndarray with the board index of every action id, None for a single board
+        n_boards: int
+            Amount of boards
+
+    Returns: np.ndarray with shape (64, 64) for a single board, (n_boards, 64, 64) otherwise
+    """
+    if board_ids is None:
+        action_space = np.zeros(shape=4096)
+        action_space[action_ids] = 1
+        return action_space.reshape(64, 64)
+    action_spaces = np.zeros(shape=(n_boards, 4096))
+    action_spaces[board_ids, action_ids] = 1
+    return action_spaces.reshape(n_boards, 64, 64)
@@ -0,0 +1,310 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1)
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+activations = {}
+activations['linear'] = lambda x: x
+activations['relu'] = relu
+activations['sigmoid'] = sigmoid
+activations['softmax'] = softmax
+activations['tanh'] = np.tanh
+
+
+def conv2d(x, kernel, bias, strides=(1, 1), data_format='channels_last'):
+    """
+    Valid 2D convolution as a single tensor contraction over sliding windows
+    Args:
+        x: np.ndarray with shape (N, H, W, C) or (N, C, H, W) for channels_first
+        kernel: np.ndarray with shape (kh, kw, C, F)
+        bias: np.ndarray with shape (F,) or None
+        strides: tuple of the row and column stride
+        data_format: 'channels_last' or 'channels_first'
+
+    Returns: np.ndarray with shape (N, H', W', F) or (N, F, H', W') for channels_first
+    """
+    if data_format == 'channels_first':
+        x = np.moveaxis(x, 1, -1)
+    kh, kw = kernel.shape[:2]
+    windows = sliding_window_view(x, (kh, kw), axis=(1, 2))[:, ::strides[0], ::strides[1]]  # N, H', W', C, kh, kw
+    y = np.tensordot(windows, kernel, axes=([4, 5, 3], [0, 1, 2]))
+    if bias is not None:
+        y += bias
+    if data_format == 'channels_first':
+        y = np.moveaxis(y, -1, 1)
+    return y
+
+
+def batch_dot(x, y, axes):
+    """
+    Batchwise dot product of two tensors along the given axes, like keras.layers.Dot
+    """
+    if x.ndim == 2:
+        return np.sum(x * y, axis=1, keepdims=True)
+    return np.matmul(np.moveaxis(x, axes[0], -1), np.moveaxis(y, axes[1], 1))
+
+
+class NumpyModel(object):
+
+    def __init__(self, model, dtype=np.float32):
+        """
+        Forward pass of a Keras functional model in NumPy, for low latency predictions on small batches.
+        Supports the layers of the RLC networks: Conv2D (valid padding), Dense, Flatten, Reshape, Concatenate,
+        Dropout, Dot, Activation and Multiply.
+        Args:
+            model: keras functional model
+            dtype: numpy float dtype of the computation
+        """
+        self.model = model
+        self.dtype = dtype
+        self.input_ids = [id(tensor) for tensor in model.inputs]
+        self.output_ids = [id(tensor) for tensor in model.outputs]
+        self.operations = []  # (layer class, config, weights, input tensor ids, output tensor id, call kwargs)
+        self.stochastic = False  # Whether Monte Carlo dropout makes the predictions random
+        self.refresh()
+
+    def refresh(self):
+        """
+        Copy the current weights of the keras model
+        Returns:
+
+        """
+        self.operations = []
+        for layer in self.model.operations:
+            layer_type = type(layer).__name__
+            if layer_type == 'InputLayer':
+                continue
+            node = layer._inbound_nodes[0]
+            config = layer.get_config()
+            if layer_type == 'Conv2D' and config['padding'] != 'valid':
+                raise ValueError("Unsupported padding " + str(config['padding']))
+            if layer_type not in layer_functions:
+                raise ValueError("Unsupported layer " + layer_type)
+            weights = [w.astype(self.dtype) for w in layer.get_weights()]
+            self.operations.append((layer_type, config, weights, [id(tensor) for tensor in node.input_tensors],
+                                    id(node.output_tensors[0]), node.arguments.kwargs))
+        self.stochastic = any(layer_type == 'Dropout' and call_kwargs.get('training') and config['rate'] > 0
+                              for layer_type, config, _, _, _, call_kwargs in self.operations)
+
+    def predict(self, x, **kwargs):
+        """
+        Predict a batch
+        Args:
+            x: np.ndarray or list of np.ndarray, one for each model input
+
+        Returns: np.ndarray, or a list of np.ndarray for multiple outputs
+        """
+        if not isinstance(x, (list, tuple)):
+            x = [x]
+        tensors = {}
+        for tensor_id, value in zip(self.input_ids, x):
+            tensors[tensor_id] = np.asarray(value, dtype=self.dtype)
+        for n, (layer_type, config, weights, input_ids, output_id, call_kwargs) in enumerate(self.operations):
+            inputs = [tensors[tensor_id] for tensor_id in input_ids]
+            tensors[output_id] = self.apply_layer(n, layer_type, inputs, config, weights, call_kwargs)
+        outputs = [tensors[tensor_id] for tensor_id in self.output_ids]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def apply_layer(self, n, layer_type, inputs, config, weights, call_kwargs):
+        return layer_functions[layer_type](inputs, config, weights, call_kwargs)
+
+    def predict_on_batch(self, x):
+        return self.predict(x)
+
+    def __call__(self, x):
+        return self.predict(x)
+
+
+class QuantizedModel(NumpyModel):
+
+    def __init__(self, model, precision='int8', calibration_states=None):
+        """
+        Reduced precision copy of a Keras functional model for inference.
+        'float16' rounds the Conv2D and Dense weights to half precision. 'int8' rounds them to int8 with a scale per
+        output channel and rounds the inputs of these layers to an 8 bit grid, with scales calibrated on
+        representative states. Inputs that are non-negative during calibration use an unsigned grid.
+        NumPy has no fast int8 or float16 matrix multiplication, so the kernels are dequantized to float32 once in
+        refresh and the products are computed in float32. The compact kernels are kept for nbytes.
+        Args:
+            model: keras functional model
+            precision: str
+                'float16' or 'int8'
+            calibration_states: np.ndarray with shape (N, 8, 8, 8), required for 'int8'
+        """
+        if precision not in ('float16', 'int8'):
+            raise ValueError("Unknown precision " + str(precision))
+        if precision == 'int8' and calibration_states is None:
+            raise ValueError("int8 quantization needs calibration states")
+        self.precision = precision
+        self.calibration_states = calibration_states
+        self.quantized_weights = {}  # operation index -> stored kernel, per channel scales
+        self.input_scales = {}  # operation index -> scale, lowest and highest level of the 8 bit input grid
+        self.input_ranges = None  # Collects the input ranges during calibration
+        NumpyModel.__init__(self, model, dtype=np.float32)
+
+    def refresh(self):
+        """
+        Copy and quantize the current weights of the keras model, then calibrate the input scales
+        Returns:
+
+        """
+        NumpyModel.refresh(self)
+        self.quantized_weights = {}
+        self.input_scales = {}
+        for n, (layer_type, config, weights, input_ids, output_id, call_kwargs) in enumerate(self.operations):
+            if layer_type not in ('Conv2D', 'Dense'):
+                continue
+            kernel = weights[0]
+            if self.precision == 'float16':
+                self.quantized_weights[n] = (kernel.astype(np.float16), None)
+            else:
+                scales = np.max(np.abs(kernel.reshape(-1, kernel.shape[-1])), axis=0) / 127
+                scales[scales == 0] = 1
+                self.quantized_weights[n] = (np.round(kernel / scales).astype(np.int8), scales.astype(np.float32))
+            stored_kernel, scales = self.quantized_weights[n]
+            weights[0] = stored_kernel.astype(np.float32) if scales is None else stored_kernel * scales
+        if self.precision == 'int8':
+            self.calibrate(self.calibration_states)
+
+    def calibrate(self, states):
+        """
+        Set the 8 bit input grids from the input ranges of the quantized layers on representative states
+        Args:
+            states: np.ndarray with shape (N, 8, 8, 8)
+
+        Returns:
+
+        """
+        self.input_scales = {}
+        self.input_ranges = {}
+        self.predict(states)
+        self.input_scales = {}
+        for n, (low, high) in self.input_ranges.items():
+            if low >= 0:
+                # Non-negative inputs, e.g. after a relu, use an unsigned grid of twice the resolution. They are not
+                # bounded above, so the grid reaches 25% beyond the calibration range to avoid clipping new positions.
+                self.input_scales[n] = (1.25 * max(high, 1e-8) / 255, 0, 255)
+            else:
+                self.input_scales[n] = (max(high, -low, 1e-8) / 127, -127, 127)
+        self.input_ranges = None
+
+    def apply_layer(self, n, layer_type, inputs, config, weights, call_kwargs):
+        if n not in self.quantized_weights:
+            return NumpyModel.apply_layer(self, n, layer_type, inputs, config, weights, call_kwargs)
+        x = inputs[0]
+        if self.input_ranges is not None:
+            self.input_ranges[n] = (float(np.min(x)), float(np.max(x)))
+        elif n in self.input_scales:
+            scale, low, high = self.input_scales[n]
+            x = np.clip(np.round(x / scale), low, high) * scale
+        return NumpyModel.apply_layer(self, n, layer_type, [x], config, weights, call_kwargs)
+
+    def nbytes(self):
+        """
+        Memory of the compact kernels
+        Returns: int
+        """
+        return sum(kernel.nbytes + (0 if scales is None else scales.nbytes)
+                   for kernel, scales in self.quantized_weights.values())
+
+
+def accuracy_report(reference, model, states):
+    """
+    Compare the predictions of a reduced precision model with a reference model
+    Args:
+        reference: model with a predict_on_batch method, e.g. the float32 NumpyModel
+        model: model with a predict_on_batch method, e.g. a QuantizedModel
+        states: np.ndarray with shape (N, 8, 8, 8) of held-out positions
+
+    Returns: dict
+        max_abs_error, mean_abs_error, relative_error (mean absolute error divided by the standard deviation of
+        the reference predictions) and correlation of the predictions
+    """
+    reference_values = np.reshape(reference.predict_on_batch(states), -1).astype(np.float64)
+    values = np.reshape(model.predict_on_batch(states), -1).astype(np.float64)
+    errors = np.abs(values - reference_values)
+    spread = np.std(reference_values)
+    return {'max_abs_error': float(np.max(errors)),
+            'mean_abs_error': float(np.mean(errors)),
+            'relative_error': float(np.mean(errors) / spread) if spread > 0 else 0.,
+            'correlation': float(np.corrcoef(reference_values, values)[0, 1]) if spread > 0 and np.std(values) > 0
+            else 1.}
+
+
+def apply_conv2d(inputs, config, weights, call_kwargs):
+    bias = weights[1] if config['use_bias'] else None
+    y = conv2d(inputs[0], weights[0], bias, strides=config['strides'], data_format=config['data_format'])
+    return activations[config['activation']](y)
+
+
+def apply_dense(inputs, config, weights, call_kwargs):
+    y = np.matmul(inputs[0], weights[0])
+    if config['use_bias']:
+        y += weights[1]
+    return activations[config['activation']](y)
+
+
+def apply_dropout(inputs, config, weights, call_kwargs):
+    """
+    Dropout is the identity at inference, unless it was called with training=True (Monte Carlo dropout)
+    """
+    x = inputs[0]
+    rate = config['rate']
+    if not call_kwargs.get('training') or rate == 0:
+        return x
+    mask = np.random.rand(*x.shape) >= rate
+    return x * mask / (1 - rate)
+
+
+def apply_flatten(inputs, config, weights, call_kwargs):
+    return inputs[0].reshape(len(inputs[0]), -1)
+
+
+def apply_reshape(inputs, config, weights, call_kwargs):
+    return inputs[0].reshape((len(inputs[0]),) + tuple(config['target_shape']))
+
+
+def apply_concatenate(inputs, config, weights, call_kwargs):
+    return np.concatenate(inputs, axis=config['axis'])
+
+
+def apply_dot(inputs, config, weights, call_kwargs):
+    if config['normalize']:
+        raise ValueError("Unsupported normalized Dot")
+    axes = config['axes'] if isinstance(config['axes'], (list, tuple)) else [config['axes']] * 2
+    return batch_dot(inputs[0], inputs[1], axes)
+
+
+def apply_activation(inputs, config, weights, call_kwargs):
+    return activations[config['activation']](inputs[0])
+
+
+def apply_multiply(inputs, config, weights, call_kwargs):
+    y = inputs[0]
+    for x in inputs[1:]:
+        y = y * x
+    return y
+
+
+layer_functions = {}
+layer_functions['Conv2D'] = apply_conv2d
+layer_functions['Dense'] = apply_dense
+layer_functions['Dropout'] = apply_dropout
+layer_functions['Flatten'] = apply_flatten
+layer_functions['Reshape'] = apply_reshape
+layer_functions['Concatenate'] = apply_concatenate
+layer_functions['Dot'] = apply_dot
+layer_functions['Activation'] = apply_activation
+layer_functions['Multiply'] = apply_multiply
@@ -1,9 +1,9 @@
-from keras.layers import Input, Dense, Flatten, Concatenate, Conv2D, Dropout
-from keras.losses import mean_squared_error
-from keras.models import Model, clone_model, load_model
-from keras.optimizers import SGD, Adam, RMSprop
 import numpy as np
 
+from RLC.encoder import material_values
+from RLC.inference import NumpyModel, QuantizedModel, accuracy_report
+from RLC.training import make_train_step, update_fixed_weights
+
 
 class RandomAgent(object):
 
@@ -11,7 +11,14 @@ class RandomAgent(object):
         self.color = color
 
     def predict(self, board_layer):
-        return np.random.randint(-5, 5) / 5
+        """
+        Random values
+        Args:
+            board_layer: np.ndarray with shape (N, 8, 8, 8)
+
+        Returns: np.ndarray with shape (N,)
+        """
+        return np.random.randint(-5, 5, size=len(board_layer)) / 5
 
     def select_move(self, board):
         moves = [x for x in board.generate_legal_moves()]
@@ -24,26 +31,58 @@ class GreedyAgent(object):
         self.color = color
 
     def predict(self, layer_board, noise=True):
-        layer_board1 = layer_board[0, :, :, :]
-        pawns = 1 * np.sum(layer_board1[0, :, :])
-        rooks = 5 * np.sum(layer_board1[1, :, :])
-        minor = 3 * np.sum(layer_board1[2:4, :, :])
-        queen = 9 * np.sum(layer_board1[4, :, :])
+        """
+        Material based values of a batch of layer boards
+        Args:
+            layer_board: np.ndarray with shape (N, 8, 8, 8)
+            noise: whether to add a small random tie breaker
+
+        Returns: np.ndarray with shape (N,)
+        """
+        material = np.dot(np.sum(layer_board[:, :6, :, :], axis=(2, 3)), material_values)
+        return self.evaluate_material(material, noise=noise)
 
+    def evaluate_material(self, material, noise=True):
+        """
+        Value of a board from its material balance, for callers that keep track of the balance themselves
+        Args:
+            material: material balance of the board, e.g. environment.get_material_value(), or an array of balances
+            noise: whether to add a small random tie breaker
+
+        Returns: board value from the perspective of this agent's color, with the shape of material
+        """
         maxscore = 40
-        material = pawns + rooks + minor + queen
         board_value = self.color * material / maxscore
-        if noise:
-            added_noise = np.random.randn() / 1e3
+        added_noise = np.random.randn(*np.shape(material)) / 1e3 if noise else 0
         return board_value + added_noise
 
 
 class Agent(object):
 
-    def __init__(self, learning_rate=0.003, network='big'):
+    def __init__(self, learning_rate=0.003, network='big', inference_precision='float32', tau=1):
+        """
+        Value network agent for real chess
+        Args:
+            learning_rate: float
+            network: str
+                'simple', 'super_simple', 'alt', 'big' or any other value for the default network
+            inference_precision: str
+                'float32', 'float16' or 'int8'. Precision of the fixed evaluator that the search uses.
+                Training always runs in full precision.
+            tau: float (0,1]
+                Update rate of the fixed model in fix_model. 1 copies the weights, smaller values make a soft
+                (Polyak) update.
+        """
+        from keras.optimizers import RMSprop  # Keras is imported when the first network is built
         self.optimizer = RMSprop(learning_rate=learning_rate)
-        self.model = Model()
+        self.model = None
         self.proportional_error = False
+        self.inference_precision = inference_precision
+        self.quantization_report = None  # Accuracy of the reduced precision fixed evaluator on held-out states
+        self.tau = tau
+        self.fixed_model = None
+        self.fixed_version = 0  # Incremented by fix_model, tags cached evaluations of the fixed model
+        self.train_step = None  # Fused training step, compiled on first use
         if network == 'simple':
             self.init_simple_network()
         elif network == 'super_simple':
@@ -55,17 +94,46 @@ class Agent(object):
         else:
             self.init_network()
 
-    def fix_model(self):
+    def fix_model(self, calibration_states=None):
         """
-        The fixed model is the model used for bootstrapping
+        The fixed model is the model used for bootstrapping. It is built once and then updated in place.
+        The fixed evaluator runs the forward pass of the fixed model in NumPy, for low latency search.
+        Args:
+            calibration_states: np.ndarray with shape (N, 8, 8, 8), e.g. recent replay states.
+                For a reduced inference precision, the first half calibrates the quantization and the second half
+                is held out for the quantization report. int8 falls back to float32 without calibration states.
         Returns:
         """
+        if self.fixed_model is None:
+            from keras.models import clone_model
 
-        self.fixed_model = clone_model(self.model)
-        self.fixed_model.compile(optimizer=self.optimizer, loss='mse', metrics=['mae'])
-        self.fixed_model.set_weights(self.model.get_weights())
+            self.fixed_model = clone_model(self.model)
+            self.fixed_model.compile(optimizer=self.optimizer, loss='mse', metrics=['mae'])
+            self.fixed_model.set_weights(self.model.get_weights())
+        else:
+            update_fixed_weights(self.fixed_model, self.model, tau=self.tau)
+        self.fixed_evaluator = NumpyModel(self.fixed_model)
+        self.quantization_report = None
+        held_out_states = None
+        if calibration_states is not None and len(calibration_states) > 1:
+            n_calibration = len(calibration_states) // 2
+            calibration_states, held_out_states = calibration_states[:n_calibration], calibration_states[n_calibration:]
+        else:
+            calibration_states = None
+        calibrated = calibration_states is not None
+        if self.inference_precision == 'float16' or (self.inference_precision == 'int8' and calibrated):
+            quantized_evaluator = QuantizedModel(self.fixed_model, precision=self.inference_precision,
+                                                 calibration_states=calibration_states)
+            if held_out_states is not None:
+                self.quantization_report = accuracy_report(self.fixed_evaluator, quantized_evaluator, held_out_states)
+            self.fixed_evaluator = quantized_evaluator
+        self.fixed_version += 1
 
     def init_network(self):
+        from keras.layers import Input, Dense, Flatten, Concatenate, Conv2D, Dropout
+        from keras.losses import mean_squared_error
+        from keras.models import Model
+
         layer_state = Input(shape=(8, 8, 8), name='state')
 
         openfile = Conv2D(3, (8, 1), padding='valid', activation='relu', name='fileconv')(layer_state)  # 3,8,1
@@ -103,6 +171,9 @@ class Agent(object):
                            )
 
     def init_simple_network(self):
+        from keras.layers import Input, Dense, Flatten, Conv2D
+        from keras.losses import mean_squared_error
+        from keras.models import Model
 
         layer_state = Input(shape=(8, 8, 8), name='state')
         conv1 = Conv2D(8, (3, 3), activation='sigmoid')(layer_state)
@@ -120,6 +191,10 @@ class Agent(object):
                            )
 
     def init_super_simple_network(self):
+        from keras.layers import Input, Dense, Flatten, Conv2D
+        from keras.losses import mean_squared_error
+        from keras.models import Model
+
         layer_state = Input(shape=(8, 8, 8), name='state')
         conv1 = Conv2D(8, (3, 3), activation='sigmoid')(layer_state)
         flat4 = Flatten()(conv1)
@@ -133,6 +208,10 @@ class Agent(object):
                            )
 
     def init_altnet(self):
+        from keras.layers import Input, Dense, Flatten, Conv2D
+        from keras.losses import mean_squared_error
+        from keras.models import Model
+
         layer_state = Input(shape=(8, 8, 8), name='state')
         conv1 = Conv2D(6, (1, 1), activation='sigmoid')(layer_state)
         flat2 = Flatten()(conv1)
@@ -147,6 +226,10 @@ class Agent(object):
                            )
 
     def init_bignet(self):
+        from keras.layers import Input, Dense, Flatten, Concatenate, Conv2D
+        from keras.losses import mean_squared_error
+        from keras.models import Model
+
         layer_state = Input(shape=(8, 8, 8), name='state')
         conv_xs = Conv2D(4, (1, 1), activation='relu')(layer_state)
         conv_s = Conv2D(8, (2, 2), strides=(1, 1), activation='relu')(layer_state)
@@ -179,20 +262,30 @@ class Agent(object):
                            loss=mean_squared_error
                            )
 
-    def predict_distribution(self, states, batch_size=256):
-        """
-        :param states: list of distinct states
-        :param n:  each state is predicted n times
-        :return:
+    def predict_distribution(self, states, n_samples=None, batch_size=256):
         """
-        predictions_per_state = int(batch_size / len(states))
-        state_batch = []
-        for state in states:
-            state_batch = state_batch + [state for x in range(predictions_per_state)]
+        Estimate the value distribution of states with stochastic (Monte Carlo dropout) forward passes
+        Args:
+            states: np.ndarray with shape (N, 8, 8, 8) or list of distinct states
+            n_samples: int
+                Amount of forward passes per state. If None, a single batch of batch_size is shared by the states,
+                with at least one pass per state.
+            batch_size: int
+                Maximum amount of forward passes in one model call
 
-        state_batch = np.stack(state_batch, axis=0)
-        predictions = self.model.predict(state_batch)
-        predictions = predictions.reshape(len(states), predictions_per_state)
+        Returns:
+            mean_pred: np.ndarray with shape (N,)
+            std_pred: np.ndarray with shape (N,)
+            upper_bound: np.ndarray with shape (N,), mean_pred + 2 * std_pred
+        """
+        states = np.asarray(states)
+        if n_samples is None:
+            n_samples = max(1, batch_size // len(states))
+        state_batch = np.repeat(states, n_samples, axis=0)
+        # A direct model call keeps the dropout layers that were built with training=True active, predict does not
+        predictions = np.concatenate([np.reshape(self.model(state_batch[i:i + batch_size]), -1)
+                                      for i in range(0, len(state_batch), batch_size)])
+        predictions = predictions.reshape(len(states), n_samples)
         mean_pred = np.mean(predictions, axis=1)
         std_pred = np.std(predictions, axis=1)
         upper_bound = mean_pred + 2 * std_pred
@@ -200,43 +293,65 @@ class Agent(object):
         return mean_pred, std_pred, upper_bound
 
     def predict(self, board_layer):
-        return self.model.predict(board_layer)
+        return self.model.predict_on_batch(board_layer)
 
-    def TD_update(self, states, rewards, sucstates, episode_active, gamma=0.9):
+    def TD_update(self, states, rewards, sucstates, episode_active, gamma=0.9, sample_weights=None, batch_size=32):
         """
         Update the SARSA-network using samples from the minibatch
         Args:
-            minibatch: list
-                The minibatch contains the states, moves, rewards and new states.
+            states: np.ndarray with shape (N, 8, 8, 8)
+            rewards: rewards of the transitions
+            sucstates: np.ndarray with shape (N, 8, 8, 8), states after the transitions
+            episode_active: 0 for transitions that end the episode, 1 otherwise
+            gamma: discount factor
+            sample_weights: importance sampling weights of the samples, None for equal weights
+            batch_size: size of the gradient descent steps, like model.fit
 
         Returns:
             td_errors: np.array
                 array of temporal difference errors
 
         """
-        suc_state_values = self.fixed_model.predict(sucstates)
-        V_target = np.array(rewards) + np.array(episode_active) * gamma * np.squeeze(suc_state_values)
-        # Perform a step of minibatch Gradient Descent.
-        self.model.fit(x=states, y=V_target, epochs=1, verbose=0)
-
-        V_state = self.model.predict(states)  # the expected future returns
-        td_errors = V_target - np.squeeze(V_state)
+        suc_state_values = self.fixed_model(np.asarray(sucstates, dtype=np.float32), training=False)
+        V_target = np.array(rewards) + np.array(episode_active) * gamma * np.reshape(suc_state_values, -1)
+        return self.train(states, V_target, sample_weights=sample_weights, batch_size=batch_size)
 
-        return td_errors
-
-    def MC_update(self, states, returns):
+    def MC_update(self, states, returns, sample_weights=None, batch_size=32):
         """
         Update network using a monte carlo playout
         Args:
             states: starting states
             returns: discounted future rewards
+            sample_weights: importance sampling weights of the samples, None for equal weights
+            batch_size: size of the gradient descent steps, like model.fit
 
         Returns:
             td_errors: np.array
                 array of temporal difference errors
         """
-        self.model.fit(x=states, y=returns, epochs=0, verbose=0)
-        V_state = np.squeeze(self.model.predict(states))
-        td_errors = returns - V_state
+        return self.train(states, returns, sample_weights=sample_weights, batch_size=batch_size)
+
+    def train(self, states, targets, sample_weights=None, batch_size=32):
+        """
+        One epoch of minibatch gradient descent with the fused train step, over the samples in random order like
+        model.fit(shuffle=True). The errors are computed in the same compiled step, so no separate prediction is
+        needed.
+        Args:
+            states: np.ndarray with shape (N, 8, 8, 8)
+            targets: target values
+            sample_weights: weights of the samples in the loss, None for equal weights
+            batch_size: size of the gradient descent steps
 
-        return td_errors
+        Returns:
+            errors: np.ndarray with shape (N,), target - value before the step
+        """
+        if self.train_step is None:
+            self.train_step = make_train_step(self.model, self.optimizer)
+        targets = np.reshape(targets, -1)
+        sample_weights = np.ones(shape=targets.shape) if sample_weights is None else np.asarray(sample_weights)
+        errors = np.zeros(shape=targets.shape)
+        order = np.random.permutation(len(targets))
+        for i in range(0, len(targets), batch_size):
+            batch = order[i:i + batch_size]
+            errors[batch] = self.train_step(states[batch], targets[batch], sample_weights[batch])
+        return errors
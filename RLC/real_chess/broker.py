@@ -0,0 +1,184 @@
+from collections import Counter, deque
+from concurrent.futures import Future
+import asyncio
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class InferenceBroker(object):
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.002, latency_window=10000):
+        """
+        Collects evaluation requests from several threads or coroutines and evaluates them in micro-batches on a
+        single worker thread.
+        Args:
+            model: model with a predict_on_batch method, e.g. agent.model or agent.fixed_evaluator
+            max_batch_size: int
+                Maximum amount of states in a micro-batch. Larger requests are evaluated on their own.
+            max_wait: float
+                Maximum time in seconds that the first request of a batch waits for more requests
+            latency_window: int
+                Amount of recent request latencies kept for the percentiles in stats
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.pending = None  # Request that did not fit in the previous batch
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        self.n_requests = 0
+        self.stats_lock = threading.Lock()  # Guards batch_sizes, latencies and n_requests
+        self.worker = None
+
+    def start(self):
+        """
+        Start the worker thread
+        Returns: the broker itself
+        """
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, name='InferenceBroker', daemon=True)
+            self.worker.start()
+        return self
+
+    def stop(self):
+        """
+        Evaluate the queued requests and stop the worker thread
+        Returns:
+
+        """
+        if self.worker is not None:
+            self.requests.put(None)
+            self.worker.join()
+            self.worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def submit(self, states):
+        """
+        Request the evaluation of states
+        Args:
+            states: np.ndarray with shape (8, 8, 8) for one state or (N, 8, 8, 8) for several
+
+        Returns: concurrent.futures.Future
+            resolves to the model output of the states with shape (N, 1)
+        """
+        if self.worker is None:
+            raise RuntimeError("The inference broker is not running, call start() or use it as a context manager")
+        states = np.asarray(states)
+        if states.ndim == 3:
+            states = np.expand_dims(states, axis=0)
+        future = Future()
+        self.requests.put((states, future, time.perf_counter()))
+        return future
+
+    def submit_async(self, states):
+        """
+        Request the evaluation of states from a coroutine
+        Args:
+            states: np.ndarray with shape (8, 8, 8) or (N, 8, 8, 8)
+
+        Returns: asyncio.Future
+            awaitable model output of the states with shape (N, 1)
+        """
+        return asyncio.wrap_future(self.submit(states))
+
+    def predict_on_batch(self, states):
+        """
+        Blocking evaluation, so the broker can be used in place of a model, for example in Node.simulate
+        Args:
+            states: np.ndarray with shape (N, 8, 8, 8)
+
+        Returns: np.ndarray with shape (N, 1)
+        """
+        return self.submit(states).result()
+
+    def predict(self, states, **kwargs):
+        return self.predict_on_batch(states)
+
+    def next_batch(self):
+        """
+        Collect requests until the batch is full or the first request has waited max_wait seconds
+        Returns: tuple
+            batch: list of requests
+            stopping: whether the broker was asked to stop
+        """
+        request = self.pending if self.pending is not None else self.requests.get()
+        self.pending = None
+        if request is None:
+            return [], True
+        batch = [request]
+        batch_size = len(request[0])
+        deadline = request[2] + self.max_wait
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            if batch_size + len(request[0]) > self.max_batch_size:
+                self.pending = request
+                break
+            batch.append(request)
+            batch_size += len(request[0])
+        return batch, False
+
+    def run(self):
+        """
+        Worker loop that evaluates micro-batches
+        Returns:
+
+        """
+        stopping = False
+        while not stopping:
+            batch, stopping = self.next_batch()
+            if not batch:
+                continue
+            sizes = [len(states) for states, _, _ in batch]
+            try:
+                values = np.asarray(self.model.predict_on_batch(np.concatenate([states for states, _, _ in batch])))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            # Record the batch before resolving the futures, so a woken caller sees it in stats
+            with self.stats_lock:
+                self.latencies.extend(finished - submitted for _, _, submitted in batch)
+                self.batch_sizes[sum(sizes)] += 1
+                self.n_requests += len(batch)
+            for (_, future, _), values_request in zip(batch, np.split(values, np.cumsum(sizes)[:-1])):
+                future.set_result(values_request)
+
+    def stats(self):
+        """
+        Report the load of the broker
+        Returns: dict
+            requests: amount of evaluated requests
+            batches: amount of evaluated micro-batches
+            queue_depth: amount of requests waiting to be batched
+            mean_batch_size: average amount of states per micro-batch
+            batch_size_histogram: dict mapping batch size to the amount of batches of that size
+            latency_percentiles: dict mapping the 50th, 90th and 99th percentile to the request latency in seconds
+        """
+        with self.stats_lock:
+            batch_sizes = dict(self.batch_sizes)
+            latencies = np.array(self.latencies)
+            n_requests = self.n_requests
+        n_batches = sum(batch_sizes.values())
+        return {'requests': n_requests,
+                'batches': n_batches,
+                'queue_depth': self.requests.qsize() + (1 if self.pending is not None else 0),
+                'mean_batch_size': sum(size * count for size, count in batch_sizes.items()) / max(n_batches, 1),
+                'batch_size_histogram': batch_sizes,
+                'latency_percentiles': {q: float(np.percentile(latencies, q)) if len(latencies) else 0.
+                                        for q in (50, 90, 99)}}
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ValueCache(object):
+
+    def __init__(self, maxsize=100000):
+        """
+        Bounded LRU cache of model evaluations, tagged with the version of the model that made them
+        Args:
+            maxsize: int
+                Maximum amount of cached evaluations
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # position key -> (model version, value)
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_version(self, version):
+        """
+        Set the version of the model whose evaluations are cached. Evaluations of other versions become misses and
+        age out of the cache, so invalidation is O(1).
+        Args:
+            version: int, e.g. agent.fixed_version
+
+        Returns:
+
+        """
+        self.version = version
+
+    def get(self, key):
+        """
+        Look up a position
+        Args:
+            key: position key from get_position_key
+
+        Returns: float or None if the position was not evaluated by the current model version
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != self.version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        """
+        Store the evaluation of a position by the current model version
+        Args:
+            key: position key from get_position_key
+            value: float
+
+        Returns:
+
+        """
+        self.entries[key] = (self.version, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def evaluate(self, model, states, keys):
+        """
+        Evaluate states, calling the model once for all states that are not cached
+        Args:
+            model: model with a predict_on_batch method
+            states: np.ndarray with shape (N, 8, 8, 8)
+            keys: list of N position keys
+
+        Returns: np.ndarray with shape (N,)
+        """
+        values = np.array([self.get(key) for key in keys], dtype=np.float64)
+        missing = np.flatnonzero(np.isnan(values))
+        if len(missing):
+            values[missing] = np.reshape(model.predict_on_batch(states[missing]), -1)
+            for i in missing:
+                self.put(keys[i], values[i])
+        return values
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
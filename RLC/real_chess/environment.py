@@ -1,24 +1,56 @@
+from collections import namedtuple
+import copy
+
 import chess
 import numpy as np
 
-mapper = {}
-mapper["p"] = 0
-mapper["r"] = 1
-mapper["n"] = 2
-mapper["b"] = 3
-mapper["q"] = 4
-mapper["k"] = 5
-mapper["P"] = 0
-mapper["R"] = 1
-mapper["N"] = 2
-mapper["B"] = 3
-mapper["Q"] = 4
-mapper["K"] = 5
+from RLC.encoder import encode_board, get_legal_actions, get_legal_actions_batch, project_legal_actions, \
+    get_material_balance, get_material_delta, get_position_key, piece_layer
+
+result_rewards = {"*": 0, "1-0": 1, "0-1": -1, "1/2-1/2": 0}
+
+Successors = namedtuple('Successors', ['moves', 'states', 'rewards', 'terminal', 'results', 'keys'], defaults=(None,))
+BoardSnapshot = namedtuple('BoardSnapshot', ['board', 'layer_board', 'material', 'result', 'undo_stack'])
+
+
+def get_result(board, draw_rules='automatic'):
+    """
+    Determine the game result of a position, checking the cheap conditions first.
+    Repetitions are only scanned for when the halfmove clock allows them.
+    Args:
+        board: python chess board
+        draw_rules: str
+            'automatic': checkmate, stalemate, insufficient material, seventy-five moves and fivefold repetition,
+                like board.result()
+            'claim': also draw when board.can_claim_draw(), like board.result(claim_draw=True). This includes the
+                claims that are made with the next move, so it is slower.
+            'basic': only checkmate, stalemate and insufficient material
+
+    Returns: str
+        "1-0", "0-1", "1/2-1/2" or "*" if the game continues
+    """
+    if not any(board.generate_legal_moves()):
+        if board.is_check():
+            return "0-1" if board.turn else "1-0"
+        return "1/2-1/2"
+    if board.is_insufficient_material():
+        return "1/2-1/2"
+    if draw_rules == 'basic':
+        return "*"
+    # A position can only recur after at least 4 reversible halfmoves
+    halfmove_clock = board.halfmove_clock
+    if halfmove_clock >= 150 or (halfmove_clock >= 16 and board.is_repetition(5)):
+        return "1/2-1/2"
+    # A claim needs a clock of 99 for the fifty-move rule, or one of 7 to reach a threefold repetition with a move
+    if draw_rules == 'claim' and halfmove_clock >= 7 and board.can_claim_draw():
+        return "1/2-1/2"
+    return "*"
 
 
 class Board(object):
 
-    def __init__(self, opposing_agent, FEN=None, capture_reward_factor=0.01):
+    def __init__(self, opposing_agent, FEN=None, capture_reward_factor=0.01, dtype=np.float64,
+                 draw_rules='automatic'):
         """
         Chess Board Environment
         Args:
@@ -26,11 +58,18 @@ class Board(object):
                 Starting FEN notation, if None then start in the default chess position
             capture_reward_factor: float [0,inf]
                 reward for capturing a piece. Multiply material gain by this number. 0 for normal chess.
+            dtype: numpy float dtype
+                dtype of the layer board, np.float32 halves its size
+            draw_rules: str
+                'automatic', 'claim' or 'basic'. The draw rules that end an episode, see get_result.
         """
         self.FEN = FEN
         self.capture_reward_factor = capture_reward_factor
+        self.dtype = dtype
+        self.draw_rules = draw_rules
         self.board = chess.Board(self.FEN) if self.FEN else chess.Board()
-        self.layer_board = np.zeros(shape=(8, 8, 8))
+        self.layer_board = np.zeros(shape=(8, 8, 8), dtype=self.dtype)
+        self.undo_stack = []  # Undo records of the incremental layer board, material and result updates
         self.init_layer_board()
         self.opposing_agent = opposing_agent
 
@@ -40,33 +79,92 @@ class Board(object):
         Returns:
 
         """
-        self.layer_board = np.zeros(shape=(8, 8, 8))
-        for i in range(64):
-            row = i // 8
-            col = i % 8
-            piece = self.board.piece_at(i)
-            if piece == None:
-                continue
-            elif piece.symbol().isupper():
-                sign = 1
+        self.layer_board = encode_board(self.board, layout='real', dtype=self.dtype)
+        self.material = get_material_balance(self.board)
+        self.result = None  # Result of the current position, determined on demand
+
+    def update_meta_layers(self, fullmove_number, turn):
+        """
+        Set the move number and turn layer of the numerical representation
+        Args:
+            fullmove_number: int
+                The full move number of the position
+            turn: bool
+                True if white is to move
+
+        Returns:
+
+        """
+        self.layer_board[6, :, :] = 1 / fullmove_number
+        self.layer_board[6, 0, :] = 1 if turn else -1
+
+    def get_move_delta(self, move):
+        """
+        Find the squares of the numerical representation that change with a move
+        Args:
+            move: python chess move, legal in the current position
+
+        Returns: tuple
+            rows and cols of the touched squares
+            placements: list of (layer, row, col, sign) to set after the touched squares are cleared
+        """
+        from_square = move.from_square
+        to_square = move.to_square
+        piece = self.board.piece_at(from_square)
+        sign = 1 if piece.color else -1
+        squares = [from_square, to_square]
+        placements = [(to_square, move.promotion if move.promotion else piece.piece_type)]
+        if self.board.is_en_passant(move):
+            squares.append(chess.square(chess.square_file(to_square), chess.square_rank(from_square)))
+        elif self.board.is_castling(move):
+            rank = chess.square_rank(from_square)
+            kingside = self.board.is_kingside_castling(move)
+            king_to = chess.square(6 if kingside else 2, rank)
+            rook_to = chess.square(5 if kingside else 3, rank)
+            if self.board.piece_type_at(to_square) == chess.ROOK:
+                rook_from = to_square  # Castling is encoded as king takes rook
             else:
-                sign = -1
-            layer = mapper[piece.symbol()]
+                rook_from = chess.square(7 if kingside else 0, rank)
+            squares.extend([king_to, rook_from, rook_to])
+            placements = [(king_to, chess.KING), (rook_to, chess.ROOK)]
+
+        rows = [square // 8 for square in squares]
+        cols = [square % 8 for square in squares]
+        placements = [(piece_layer[piece_type], square // 8, square % 8, sign) for square, piece_type in placements]
+        return rows, cols, placements
+
+    def update_layer_board(self, move):
+        """
+        Incrementally update the numerical representation and material balance for a move that is about to be pushed.
+        The cached result is cleared.
+        Only the squares touched by the move are rewritten. Their previous contents are stored on the undo stack.
+        Args:
+            move: python chess move, legal in the current position
+
+        Returns:
+
+        """
+        rows, cols, placements = self.get_move_delta(move)
+        self.undo_stack.append((rows, cols, self.layer_board[:6, rows, cols].copy(), self.material, self.result))
+        self.material += get_material_delta(self.board, move)
+        self.result = None
+
+        self.layer_board[:6, rows, cols] = 0
+        for layer, row, col, sign in placements:
             self.layer_board[layer, row, col] = sign
-            self.layer_board[6, :, :] = 1 / self.board.fullmove_number
-        if self.board.turn:
-            self.layer_board[6, 0, :] = 1
-        else:
-            self.layer_board[6, 0, :] = -1
-        self.layer_board[7, :, :] = 1
-
-    def update_layer_board(self, move=None):
-        self._prev_layer_board = self.layer_board.copy()
-        self.init_layer_board()
+        fullmove_number = self.board.fullmove_number + (0 if self.board.turn else 1)
+        self.update_meta_layers(fullmove_number, not self.board.turn)
 
     def pop_layer_board(self):
-        self.layer_board = self._prev_layer_board.copy()
-        self._prev_layer_board = None
+        """
+        Revert the latest incremental update of the numerical representation, material balance and cached result.
+        Call after the move has been popped from the board.
+        Returns:
+
+        """
+        rows, cols, columns, self.material, self.result = self.undo_stack.pop()
+        self.layer_board[:6, rows, cols] = columns
+        self.update_meta_layers(self.board.fullmove_number, self.board.turn)
 
     def step(self, action, test=True):
         """
@@ -80,27 +178,112 @@ class Board(object):
                 Difference in material value after the move
         """
         piece_balance_before = self.get_material_value()
-        self.board.push(action)
         self.update_layer_board(action)
+        self.board.push(action)
         piece_balance_after = self.get_material_value()
         auxiliary_reward = (piece_balance_after - piece_balance_before) * self.capture_reward_factor
-        result = self.board.result()
-        if result == "*":
-            reward = 0
-            episode_end = False
-        elif result == "1-0":
-            reward = 1
-            episode_end = True
-        elif result == "0-1":
-            reward = -1
-            episode_end = True
-        elif result == "1/2-1/2":
-            reward = 0
-            episode_end = True
-        reward += auxiliary_reward
+        result = self.get_result()
+        episode_end = result != "*"
+        reward = result_rewards[result] + auxiliary_reward
 
         return episode_end, reward
 
+    def get_result(self):
+        """
+        Result of the current position under the draw rules of the environment. It is determined once per position.
+        Returns: str
+            "1-0", "0-1", "1/2-1/2" or "*" if the game continues
+        """
+        if self.result is None:
+            self.result = get_result(self.board, draw_rules=self.draw_rules)
+        return self.result
+
+    def unstep(self):
+        """
+        Undo the last step
+        Returns:
+
+        """
+        self.board.pop()
+        self.pop_layer_board()
+
+    def encode_successors(self, keys=False):
+        """
+        Encode the successor states of all legal moves without stepping the environment.
+        Each successor is derived from the current layer board with the move delta.
+        Args:
+            keys: whether to compute the position keys of the successors, for a ValueCache
+        Returns: Successors namedtuple
+            moves: list of legal python chess moves
+            states: np.ndarray with shape (n_moves, 8, 8, 8)
+            rewards: np.ndarray with the reward of each move, as returned by step
+            terminal: np.ndarray of booleans, True if the move ends the episode
+            results: list of game results after each move
+            keys: list of position keys after each move, None if keys is False
+        """
+        moves = [x for x in self.board.generate_legal_moves()]
+        states = np.repeat(np.expand_dims(self.layer_board, axis=0), len(moves), axis=0)
+        for state, move in zip(states, moves):
+            rows, cols, placements = self.get_move_delta(move)
+            state[:6, rows, cols] = 0
+            for layer, row, col, sign in placements:
+                state[layer, row, col] = sign
+        states[:, 6, :, :] = 1 / (self.board.fullmove_number + (0 if self.board.turn else 1))
+        states[:, 6, 0, :] = -1 if self.board.turn else 1
+
+        results = []
+        material_deltas = []
+        position_keys = [] if keys else None
+        for move in moves:
+            material_deltas.append(get_material_delta(self.board, move))
+            self.board.push(move)
+            results.append(get_result(self.board, draw_rules=self.draw_rules))
+            if keys:
+                position_keys.append(get_position_key(self.board))
+            self.board.pop()
+
+        auxiliary_rewards = np.array(material_deltas) * self.capture_reward_factor
+        rewards = np.array([result_rewards[result] for result in results]) + auxiliary_rewards
+        terminal = np.array([result != "*" for result in results], dtype=bool)
+
+        return Successors(moves, states, rewards, terminal, results, position_keys)
+
+    def snapshot(self):
+        """
+        Take a snapshot of the environment state. The snapshot shares no mutable state with the environment and
+        can be pickled to send it to another process.
+        Returns: BoardSnapshot namedtuple
+            the python chess board with its move stack, the layer board, the material balance, the cached result
+            and the undo stack
+        """
+        return BoardSnapshot(self.board.copy(stack=True), self.layer_board.copy(), self.material, self.result,
+                             list(self.undo_stack))
+
+    def restore(self, snapshot):
+        """
+        Restore the environment to a snapshot. The snapshot can be restored again later.
+        Args:
+            snapshot: BoardSnapshot namedtuple
+
+        Returns:
+
+        """
+        self.board = snapshot.board.copy(stack=True)
+        self.layer_board = snapshot.layer_board.copy()
+        self.material = snapshot.material
+        self.result = snapshot.result
+        self.undo_stack = list(snapshot.undo_stack)  # Undo records are never mutated, a shallow copy suffices
+
+    def fork(self):
+        """
+        Create an independent copy of the environment, for example for a search worker
+        Returns: Board
+            a new environment in the same state, sharing only the opposing agent
+        """
+        forked = copy.copy(self)
+        forked.restore(BoardSnapshot(self.board, self.layer_board, self.material, self.result, self.undo_stack))
+        return forked
+
     def get_random_action(self):
         """
         Sample a random action
@@ -112,27 +295,33 @@ class Board(object):
         legal_moves = np.random.choice(legal_moves)
         return legal_moves
 
-    def project_legal_moves(self):
+    def get_legal_actions(self):
+        """
+        Get the legal actions in sparse form
+        Returns: tuple
+            action_ids: np.ndarray with the action id (from_square * 64 + to_square) of every legal move
+            moves: dict mapping action id to python chess move
+        """
+        return get_legal_actions(self.board)
+
+    def project_legal_moves(self, action_ids=None):
         """
         Create a mask of legal actions
+        Args:
+            action_ids: legal action ids from get_legal_actions, determined from the board if None
         Returns: np.ndarray with shape (64,64)
         """
-        self.action_space = np.zeros(shape=(64, 64))
-        moves = [[x.from_square, x.to_square] for x in self.board.generate_legal_moves()]
-        for move in moves:
-            self.action_space[move[0], move[1]] = 1
+        if action_ids is None:
+            action_ids, _ = self.get_legal_actions()
+        self.action_space = project_legal_actions(action_ids)
         return self.action_space
 
     def get_material_value(self):
         """
-        Sums up the material balance using Reinfield values
+        Material balance using Reinfield values, kept up to date incrementally by step and unstep
         Returns: The material balance on the board
         """
-        pawns = 1 * np.sum(self.layer_board[0, :, :])
-        rooks = 5 * np.sum(self.layer_board[1, :, :])
-        minor = 3 * np.sum(self.layer_board[2:4, :, :])
-        queen = 9 * np.sum(self.layer_board[4, :, :])
-        return pawns + rooks + minor + queen
+        return self.material
 
     def reset(self):
         """
@@ -141,4 +330,79 @@ class Board(object):
 
         """
         self.board = chess.Board(self.FEN) if self.FEN else chess.Board()
+        self.undo_stack = []
         self.init_layer_board()
+
+
+class VectorBoard(object):
+
+    def __init__(self, opposing_agent, n_boards=8, FEN=None, capture_reward_factor=0.01, dtype=np.float64):
+        """
+        N chess board environments that are stepped in lockstep. Finished games are reset automatically.
+        Args:
+            opposing_agent: the opposing agent of every board
+            n_boards: int
+                Amount of games played at the same time
+            FEN: str
+                Starting FEN notation of every game, if None then start in the default chess position
+            capture_reward_factor: float [0,inf]
+                reward for capturing a piece. Multiply material gain by this number. 0 for normal chess.
+            dtype: numpy float dtype
+                dtype of the layer boards
+        """
+        self.envs = [Board(opposing_agent, FEN=FEN, capture_reward_factor=capture_reward_factor, dtype=dtype)
+                     for _ in range(n_boards)]
+        self.layer_boards = np.zeros(shape=(n_boards, 8, 8, 8), dtype=dtype)
+        self.update_layer_boards()
+
+    def __len__(self):
+        return len(self.envs)
+
+    def update_layer_boards(self):
+        """
+        Gather the layer boards of all environments
+        Returns: np.ndarray with shape (N, 8, 8, 8)
+        """
+        for n, env in enumerate(self.envs):
+            self.layer_boards[n] = env.layer_board
+        return self.layer_boards
+
+    def project_legal_moves(self):
+        """
+        Create a mask of legal actions for every board
+        Returns: np.ndarray with shape (N, 64, 64)
+        """
+        board_ids, action_ids, _ = get_legal_actions_batch([env.board for env in self.envs])
+        return project_legal_actions(action_ids, board_ids=board_ids, n_boards=len(self.envs))
+
+    def step(self, actions):
+        """
+        Run a step on every board
+        Args:
+            actions: list of N python chess moves, one for every board
+        Returns:
+            states: np.ndarray with shape (N, 8, 8, 8)
+                layer boards after the step. Boards whose game ended are already reset to the starting position.
+            rewards: np.ndarray with shape (N,)
+            episode_ends: np.ndarray of booleans with shape (N,)
+            action_spaces: np.ndarray with shape (N, 64, 64)
+                legal move masks of the returned states
+        """
+        rewards = np.zeros(shape=len(self.envs))
+        episode_ends = np.zeros(shape=len(self.envs), dtype=bool)
+        for n, (env, action) in enumerate(zip(self.envs, actions)):
+            episode_ends[n], rewards[n] = env.step(action)
+            if episode_ends[n]:
+                env.reset()
+        return self.update_layer_boards().copy(), rewards, episode_ends, self.project_legal_moves()
+
+    def reset(self):
+        """
+        Reset every board
+        Returns:
+            states: np.ndarray with shape (N, 8, 8, 8)
+            action_spaces: np.ndarray with shape (N, 64, 64)
+        """
+        for env in self.envs:
+            env.reset()
+        return self.update_layer_boards().copy(), self.project_legal_moves()
@@ -1,6 +1,8 @@
 import numpy as np
 import time
-from RLC.real_chess.tree import Node
+from RLC.real_chess.tree import Node, evaluate_successors
+from RLC.real_chess.cache import ValueCache
+from RLC.replay import PrioritizedReplayMemory, frame_capacity
 import math
 import gc
 
@@ -13,9 +15,13 @@ def sigmoid(x):
     return 1 / (1 + math.exp(-x))
 
 
+transition_columns = {'reward': np.float64, 'error': np.float64, 'episode_active': np.float64}
+
+
 class TD_search(object):
 
-    def __init__(self, env, agent, gamma=0.9, search_time=1, memsize=2000, batch_size=256, temperature=1):
+    def __init__(self, env, agent, gamma=0.9, search_time=1, memsize=2000, batch_size=256, temperature=1,
+                 state_dtype=np.int8, cache_size=100000, alpha=1, beta=0, memory=None):
         """
         Chess algorithm that combines bootstrapped monte carlo tree search with Q Learning
         Args:
@@ -26,6 +32,14 @@ class TD_search(object):
             memsize: Amount of training samples to keep in-memory
             batch_size: Size of the training batches
             temperature: softmax temperature for mcts
+            state_dtype: storage dtype of the states in memory. np.int8 stores compact states of 400 bytes.
+            cache_size: maximum amount of cached fixed model evaluations in the search, 0 disables the cache.
+                The cache is not used while the fixed evaluator is stochastic (Monte Carlo dropout), because it would
+                replace the fresh samples of a position by the first one.
+            alpha: prioritized replay exponent, samples are drawn proportional to abs(TD error) ** alpha
+            beta: importance sampling exponent of the prioritized replay, 0 disables the importance sampling weights
+            memory: prioritized replay memory with the transition_columns, e.g. a RLC.replay.MemmapReplayMemory to
+                keep the replay on disk. None for a memory in RAM of memsize samples.
         """
         self.env = env
         self.agent = agent
@@ -39,12 +53,13 @@ class TD_search(object):
         self.ready = False  # Whether to start training
         self.search_time = search_time
         self.min_sim_count = 10
+        self.state_dtype = state_dtype
+        self.value_cache = ValueCache(maxsize=cache_size) if cache_size else None
 
-        self.mem_state = np.zeros(shape=(1, 8, 8, 8))
-        self.mem_sucstate = np.zeros(shape=(1, 8, 8, 8))
-        self.mem_reward = np.zeros(shape=(1))
-        self.mem_error = np.zeros(shape=(1))
-        self.mem_episode_active = np.ones(shape=(1))
+        if memory is None:
+            memory = PrioritizedReplayMemory(memsize, columns=transition_columns, state_dtype=self.state_dtype,
+                                             frame_capacity=frame_capacity(memsize), alpha=alpha, beta=beta)
+        self.memory = memory
 
     def learn(self, iters=40, c=5, timelimit_seconds=3600, maxiter=80):
         """
@@ -61,11 +76,14 @@ class TD_search(object):
         for k in range(iters):
             self.env.reset()
             if k % c == 0:
-                self.agent.fix_model()
+                # Only reduced precision evaluators are calibrated on recent states
+                quantized = self.agent.inference_precision != 'float32'
+                self.agent.fix_model(calibration_states=self.get_recent_states() if quantized else None)
                 print("iter", k)
             if k > c:
                 self.ready = True
             self.play_game(k, maxiter=maxiter)
+            self.memory.flush()
             if starttime + timelimit_seconds < time.time():
                 break
         return self.env.board
@@ -98,7 +116,7 @@ class TD_search(object):
                     tree = self.mcts(tree)
                     # Step the best move
                     max_move = None
-                    max_value = np.NINF
+                    max_value = -np.inf
                     for move, child in tree.children.items():
                         sampled_value = np.mean(child.values)
                         if sampled_value > max_value:
@@ -109,23 +127,12 @@ class TD_search(object):
 
             # Black's turn is myopic
             else:
-                max_move = None
-                max_value = np.NINF
-                for move in self.env.board.generate_legal_moves():
-                    self.env.step(move)
-                    if self.env.board.result() == "0-1":
-                        max_move = move
-                        self.env.board.pop()
-                        self.env.init_layer_board()
-                        break
-                    successor_state_value_opponent = self.env.opposing_agent.predict(
-                        np.expand_dims(self.env.layer_board, axis=0))
-                    if successor_state_value_opponent > max_value:
-                        max_move = move
-                        max_value = successor_state_value_opponent
-
-                    self.env.board.pop()
-                    self.env.init_layer_board()
+                successors = self.env.encode_successors()
+                if "0-1" in successors.results:
+                    max_move = successors.moves[successors.results.index("0-1")]
+                else:
+                    successor_state_values_opponent = self.env.opposing_agent.predict(successors.states)
+                    max_move = successors.moves[int(np.argmax(successor_state_values_opponent))]
 
             if not (self.env.board.turn and max_move not in tree.children.keys()) or not k > start_mcts_after:
                 tree.children[max_move] = Node(gamma=0.9, parent=tree)
@@ -140,7 +147,7 @@ class TD_search(object):
             new_state_value = self.agent.predict(sucstate)
 
             error = reward + self.gamma * new_state_value - state_value
-            error = np.float(np.squeeze(error))
+            error = float(np.squeeze(error))
 
             turncount += 1
             if turncount > maxiter and not episode_end:
@@ -149,20 +156,9 @@ class TD_search(object):
             episode_active = 0 if episode_end else 1
 
             # construct training sample state, prediction, error
-            self.mem_state = np.append(self.mem_state, state, axis=0)
-            self.mem_reward = np.append(self.mem_reward, reward)
-            self.mem_sucstate = np.append(self.mem_sucstate, sucstate, axis=0)
-            self.mem_error = np.append(self.mem_error, error)
-            self.reward_trace = np.append(self.reward_trace, reward)
-            self.mem_episode_active = np.append(self.mem_episode_active, episode_active)
-
-            if self.mem_state.shape[0] > self.memsize:
-                self.mem_state = self.mem_state[1:]
-                self.mem_reward = self.mem_reward[1:]
-                self.mem_sucstate = self.mem_sucstate[1:]
-                self.mem_error = self.mem_error[1:]
-                self.mem_episode_active = self.mem_episode_active[1:]
-                gc.collect()
+            self.memory.add(priority=error, state=state, reward=reward, sucstate=sucstate, error=error,
+                            episode_active=episode_active)
+            self.reward_trace.append(reward)
 
             if turncount % 10 == 0:
                 self.update_agent()
@@ -180,37 +176,45 @@ class TD_search(object):
             None
         """
         if self.ready:
-            choice_indices, states, rewards, sucstates, episode_active = self.get_minibatch()
-            td_errors = self.agent.TD_update(states, rewards, sucstates, episode_active, gamma=self.gamma)
-            self.mem_error[choice_indices.tolist()] = td_errors
+            choice_indices, states, rewards, sucstates, episode_active, weights = self.get_minibatch()
+            td_errors = self.agent.TD_update(states, rewards, sucstates, episode_active, gamma=self.gamma,
+                                             sample_weights=weights)
+            self.memory['error'][choice_indices] = td_errors
+            self.memory.update_priorities(choice_indices, td_errors)
 
     def get_minibatch(self, prioritized=True):
         """
         Get a mini batch of experience
         Args:
-            prioritized:
+            prioritized: whether to sample proportional to the TD error priorities, otherwise uniformly
 
         Returns:
-
+            choice_indices, states, rewards, sucstates, episode_active and the importance sampling weights
         """
         if prioritized:
-            sampling_priorities = np.abs(self.mem_error) + 1e-9
+            choice_indices, weights = self.memory.sample(min(len(self.memory), self.batch_size))
         else:
-            sampling_priorities = np.ones(shape=self.mem_error.shape)
-        sampling_probs = sampling_priorities / np.sum(sampling_priorities)
-        sample_indices = [x for x in range(self.mem_state.shape[0])]
-        choice_indices = np.random.choice(sample_indices,
-                                          min(self.mem_state.shape[0],
-                                              self.batch_size),
-                                          p=np.squeeze(sampling_probs),
-                                          replace=False
-                                          )
-        states = self.mem_state[choice_indices]
-        rewards = self.mem_reward[choice_indices]
-        sucstates = self.mem_sucstate[choice_indices]
-        episode_active = self.mem_episode_active[choice_indices]
-
-        return choice_indices, states, rewards, sucstates, episode_active
+            valid_indices = self.memory.valid_indices()
+            choice_indices = np.random.choice(valid_indices, min(len(valid_indices), self.batch_size), replace=False)
+            weights = np.ones(shape=len(choice_indices))
+        states, sucstates = self.memory.get_state_columns(('state', 'sucstate'), choice_indices)
+        rewards = self.memory['reward'][choice_indices]
+        episode_active = self.memory['episode_active'][choice_indices]
+
+        return choice_indices, states, rewards, sucstates, episode_active, weights
+
+    def get_recent_states(self, n_states=512):
+        """
+        Get the most recent states in memory, e.g. to calibrate a quantized evaluator
+        Args:
+            n_states: maximum amount of states
+
+        Returns: np.ndarray with shape (N, 8, 8, 8) or None if the memory holds no played states yet
+        """
+        indices = self.memory.valid_indices()[-n_states:]
+        if len(indices) == 0:
+            return None
+        return self.memory.get_states('state', indices)
 
     def mcts(self, node):
         """
@@ -227,27 +231,18 @@ class TD_search(object):
         sim_count = 0
         board_in = self.env.board.fen()
 
-        # First make a prediction for each child state
-        for move in self.env.board.generate_legal_moves():
+        # First make a prediction for each child state, in one batch
+        successors = self.env.encode_successors()
+        child_values = evaluate_successors(self.agent.model, successors, gamma=self.gamma)
+        for move, child_value in zip(successors.moves, child_values):
             if move not in node.children.keys():
                 node.children[move] = Node(self.env.board, parent=node)
-
-            episode_end, reward = self.env.step(move)
-
-            if episode_end:
-                successor_state_value = 0
-            else:
-                successor_state_value = np.squeeze(
-                    self.agent.model.predict(np.expand_dims(self.env.layer_board, axis=0))
-                )
-
-            child_value = reward + self.gamma * successor_state_value
-
             node.update_child(move, child_value)
-            self.env.board.pop()
-            self.env.init_layer_board()
         if not node.values:
             node.values = [0]
+        cache = None if self.agent.fixed_evaluator.stochastic else self.value_cache
+        if cache is not None:
+            cache.set_version(self.agent.fixed_version)
 
         while starttime + self.search_time > time.time() or sim_count < self.min_sim_count:
             depth = 0
@@ -267,27 +262,25 @@ class TD_search(object):
                     node_rewards.append(reward)
                     # Check best node is terminal
 
-                    if self.env.board.result() == "1-0" and depth == 1:  # -> Direct win for white, no need for mcts.
-                        self.env.board.pop()
-                        self.env.init_layer_board()
+                    if self.env.get_result() == "1-0" and depth == 1:  # -> Direct win for white, no need for mcts.
+                        self.env.unstep()
                         node.update(1)
                         node = node.parent
                         return node
                     elif episode_end:  # -> if the explored tree leads to a terminal state, simulate from root.
                         while node.parent:
-                            self.env.board.pop()
-                            self.env.init_layer_board()
+                            self.env.unstep()
                             node = node.parent
                         break
                     else:
                         continue
 
             # Expand the game tree with a simulation
-            Returns, move = node.simulate(self.agent.fixed_model,
+            Returns, move = node.simulate(self.agent.fixed_evaluator,
                                           self.env,
                                           temperature=self.temperature,
-                                          depth=0)
-            self.env.init_layer_board()
+                                          depth=0,
+                                          cache=cache)
 
             if move not in node.children.keys():
                 node.children[move] = Node(self.env.board, parent=node)
@@ -301,8 +294,7 @@ class TD_search(object):
                 node.update(Returns)
                 node = node.parent
 
-                self.env.board.pop()
-                self.env.init_layer_board()
+                self.env.unstep()
             sim_count += 1
 
         board_out = self.env.board.fen()
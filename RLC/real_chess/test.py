@@ -1,6 +1,4 @@
 import numpy as np  # linear algebra
-import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv)
-import matplotlib.pyplot as plt
 import os
 
 from RLC.real_chess import agent, environment, learn, tree
@@ -16,6 +14,9 @@ player.model.summary()
 
 learner.learn(iters=1000, timelimit_seconds=3600)
 
+import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv), imported after training
+import matplotlib.pyplot as plt
+
 reward_smooth = pd.DataFrame(learner.reward_trace)
 reward_smooth.rolling(window=500, min_periods=0).mean().plot(figsize=(16, 9),
                                                              title='average performance over the last 3 episodes')
@@ -1,10 +1,37 @@
 import numpy as np
 
+from RLC.encoder import get_position_key
+
 
 def softmax(x, temperature=1):
     return np.exp(x / temperature) / np.sum(np.exp(x / temperature))
 
 
+def evaluate_successors(model, successors, gamma=0.9, cache=None):
+    """
+    Value the successors of a position with a single batched model call
+    Args:
+        model: The model used for bootstrap estimation
+        successors: Successors namedtuple from environment.encode_successors
+        gamma: the discount factor
+        cache: ValueCache of the model. Only used if the successors carry position keys.
+
+    Returns: np.ndarray
+        reward + gamma * estimated state value for every successor. Terminal successors are valued by their reward
+        and are not evaluated by the model.
+    """
+    values = np.array(successors.rewards, dtype=np.float64)
+    active = ~successors.terminal
+    if not np.any(active):
+        return values
+    if cache is not None and successors.keys is not None:
+        keys = [key for key, is_active in zip(successors.keys, active) if is_active]
+        values[active] += gamma * cache.evaluate(model, successors.states[active], keys)
+    else:
+        values[active] += gamma * np.reshape(model.predict_on_batch(successors.states[active]), -1)
+    return values
+
+
 class Node(object):
 
     def __init__(self, board=None, parent=None, gamma=0.9):
@@ -74,7 +101,7 @@ class Node(object):
         else:
             return self, None
 
-    def simulate(self, model, env, depth=0, max_depth=4, random=False, temperature=1):
+    def simulate(self, model, env, depth=0, max_depth=4, random=False, temperature=1, cache=None):
         """
         Recursive Monte Carlo Playout
         Args:
@@ -83,6 +110,7 @@ class Node(object):
             depth: The recursion depth
             max_depth: How deep to search
             temperature: softmax temperature
+            cache: ValueCache of the model, None to evaluate every position with the model
 
         Returns:
             Playout result.
@@ -91,50 +119,34 @@ class Node(object):
         if env.board.turn and random:
             move = np.random.choice([x for x in env.board.generate_legal_moves()])
         else:
-            successor_values = []
-            for move in env.board.generate_legal_moves():
-                episode_end, reward = env.step(move)
-                result = env.board.result()
-
-                if (result == "1-0" and env.board.turn) or (
-                        result == "0-1" and not env.board.turn):
-                    env.board.pop()
-                    env.init_layer_board()
-                    break
-                else:
-                    if env.board.turn:
-                        sucval = reward + self.gamma * np.squeeze(
-                            model.predict(np.expand_dims(env.layer_board, axis=0)))
-                    else:
-                        sucval = np.squeeze(env.opposing_agent.predict(np.expand_dims(env.layer_board, axis=0)))
-                    successor_values.append(sucval)
-                    env.board.pop()
-                    env.init_layer_board()
-
-            if not episode_end:
-                if env.board.turn:
-                    move_probas = softmax(np.array(successor_values), temperature=temperature)
-                    moves = [x for x in env.board.generate_legal_moves()]
-                else:
-                    move_probas = np.zeros(len(successor_values))
-                    move_probas[np.argmax(successor_values)] = 1
-                    moves = [x for x in env.board.generate_legal_moves()]
-                if len(moves) == 1:
-                    move = moves[0]
-                else:
-                    move = np.random.choice(moves, p=np.squeeze(move_probas))
+            successors = env.encode_successors(keys=cache is not None)
+            winning_result = "1-0" if env.board.turn else "0-1"
+            if winning_result in successors.results:  # An immediate win is always played
+                move = successors.moves[successors.results.index(winning_result)]
+            elif env.board.turn:
+                successor_values = evaluate_successors(model, successors, gamma=self.gamma, cache=cache)
+                move_probas = softmax(successor_values, temperature=temperature)
+                move = successors.moves[np.random.choice(len(successors.moves), p=move_probas)]
+            else:
+                successor_values = env.opposing_agent.predict(successors.states)
+                move = successors.moves[int(np.argmax(successor_values))]
 
         episode_end, reward = env.step(move)
 
         if episode_end:
             Returns = reward
         elif depth >= max_depth:  # Bootstrap the Monte Carlo Playout
-            Returns = reward + self.gamma * np.squeeze(model.predict(np.expand_dims(env.layer_board, axis=0)))
+            state = np.expand_dims(env.layer_board, axis=0)
+            if cache is not None:
+                state_value = cache.evaluate(model, state, [get_position_key(env.board)])[0]
+            else:
+                state_value = np.squeeze(model.predict_on_batch(state))
+            Returns = reward + self.gamma * state_value
         else:  # Recursively continue
-            Returns = reward + self.gamma * self.simulate(model, env, depth=depth + 1,temperature=temperature)
+            Returns = reward + self.gamma * self.simulate(model, env, depth=depth + 1, temperature=temperature,
+                                                          cache=cache)
 
-        env.board.pop()
-        env.init_layer_board()
+        env.unstep()
 
         board_out = env.board.fen()
         assert board_in == board_out
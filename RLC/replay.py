@@ -0,0 +1,647 @@
+import functools
+import json
+import os
+
+import numpy as np
+
+from RLC.encoder import pack_states, unpack_states
+
+
+def counter(name):
+    """
+    Property for a field of the index record of a memory
+    """
+    return property(lambda self: self.index[name][0].item(),
+                    lambda self, value: self.index[name].__setitem__(0, value))
+
+
+index_fields = [('n_added', np.int64), ('first_valid', np.int64), ('frames_written', np.int64),
+                ('max_priority', np.float64)]
+
+layout_version = 1  # Version of the files of a MemmapReplayMemory, stored in layout.json
+
+
+def frame_capacity(capacity, min_game_length=4):
+    """
+    Size of a frame store for a replay of games. A game of n moves needs n + 1 frames.
+    Args:
+        capacity: int
+            Amount of samples of the memory
+        min_game_length: int
+            Shortest average game length, in moves, for which all samples stay valid
+
+    Returns: int
+    """
+    return capacity + capacity // min_game_length + 1
+
+
+class ReplayMemory(object):
+
+    n_added = counter('n_added')  # Amount of samples added so far
+    first_valid = counter('first_valid')  # Number of the oldest sample whose frames are not overwritten
+    frames_written = counter('frames_written')
+    max_priority = counter('max_priority')
+
+    def __init__(self, capacity, columns=None, state_columns=('state', 'sucstate'), state_dtype=np.int8,
+                 frame_capacity=None):
+        """
+        Replay memory with fixed capacity. The columns are preallocated and written at a cursor that wraps around,
+        so the oldest samples are overwritten once the memory is full.
+        With a frame store, every layer board is stored once in a ring of frames and the state columns hold frame
+        numbers. A state that equals the previous frame, like the state after the sucstate of the previous move of
+        a game, reuses that frame. The first state of a new game differs from the last frame and gets its own frame.
+        Samples whose frames are overwritten are no longer valid.
+        Args:
+            capacity: int
+                Maximum amount of samples
+            columns: dict
+                Maps the name of each column to its dtype, or to a (dtype, shape) tuple for array valued samples
+            state_columns: tuple
+                Names of the columns that hold layer boards
+            state_dtype: storage dtype of the layer boards, see encoder.pack_states
+            frame_capacity: int
+                Amount of frames in the frame store, None stores the layer boards of every state column
+        """
+        self.capacity = capacity
+        self.state_columns = tuple(state_columns)
+        self.state_dtype = state_dtype
+        self.frame_capacity = frame_capacity
+        if frame_capacity is not None and frame_capacity < 2:
+            raise ValueError("The frame store needs at least 2 frames")
+        self.index = self.allocate('index', (1,), index_fields)
+        self.columns = {}
+        for name, dtype in (columns or {}).items():
+            dtype, shape = dtype if isinstance(dtype, tuple) else (dtype, ())
+            self.columns[name] = self.allocate_column(name, (capacity,) + tuple(shape), dtype)
+        empty_state = pack_states(np.zeros(shape=(1, 8, 8, 8)), dtype=state_dtype)
+        self.frames = None
+        if frame_capacity is not None:
+            self.frames = self.allocate_column('frames', (frame_capacity,) + empty_state.shape[1:], empty_state.dtype)
+        for name in self.state_columns:
+            if self.frames is None:
+                self.columns[name] = self.allocate_column(name, (capacity,) + empty_state.shape[1:],
+                                                          empty_state.dtype)
+            else:
+                self.columns[name] = self.allocate_column(name, (capacity,), np.int64)
+
+    @property
+    def cursor(self):
+        """Position of the next write"""
+        return self.n_added % self.capacity
+
+    @property
+    def size(self):
+        return min(self.n_added, self.capacity)
+
+    def allocate(self, name, shape, dtype=np.float64):
+        """
+        Create a zero filled array for the memory
+        Args:
+            name: name of the array
+            shape: tuple
+            dtype: numpy dtype
+
+        Returns: np.ndarray
+        """
+        return np.zeros(shape=shape, dtype=dtype)
+
+    def allocate_column(self, name, shape, dtype):
+        return self.allocate(name, shape, dtype)
+
+    def flush(self):
+        """
+        Write the memory to its storage, nothing to do for a memory in RAM
+        Returns:
+
+        """
+        pass
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        """
+        View of the filled part of a column, in storage order
+        Args:
+            name: column name
+
+        Returns: np.ndarray view, writes go to the memory
+        """
+        return self.columns[name][:self.size]
+
+    def add(self, **sample):
+        """
+        Store a sample, overwriting the oldest sample if the memory is full
+        Args:
+            **sample: a value for every column. States have shape (8, 8, 8) or (1, 8, 8, 8).
+
+        Returns: int
+            the index of the sample
+        """
+        index = self.cursor
+        for name in self.state_columns:  # In column order, so that a state can share the frame of a sucstate
+            if name in sample:
+                value = pack_states(np.reshape(sample[name], (1, 8, 8, 8)), dtype=self.state_dtype)[0]
+                if self.frames is not None:
+                    value = self.add_frame(value)
+                self.columns[name][index] = value
+        for name, value in sample.items():
+            if name not in self.state_columns:
+                self.columns[name][index] = value
+        self.n_added += 1
+        if self.frames is not None:
+            self.invalidate()
+        return index
+
+    def add_frame(self, frame):
+        """
+        Store a packed layer board in the frame store, unless it equals the last frame
+        Args:
+            frame: packed layer board
+
+        Returns: int
+            the frame number
+        """
+        frames_written = self.frames_written
+        if frames_written > 0 and self.frames[(frames_written - 1) % self.frame_capacity].tobytes() == frame.tobytes():
+            return frames_written - 1
+        self.frames[frames_written % self.frame_capacity] = frame
+        self.frames_written = frames_written + 1
+        return frames_written
+
+    def invalidate(self):
+        """
+        Advance first_valid past the samples that are overwritten or whose frames are overwritten. Frame numbers
+        increase with the sample number, so these are always the oldest samples.
+        """
+        first_valid = max(self.first_valid, self.n_added - self.capacity)
+        while first_valid < self.n_added and not self.is_valid(first_valid % self.capacity):
+            self.discard(first_valid % self.capacity)
+            first_valid += 1
+        self.first_valid = first_valid
+
+    def discard(self, index):
+        """
+        Called for a sample whose frames are overwritten, so that subclasses can stop sampling it
+        Args:
+            index: sample index
+        """
+        pass
+
+    def is_valid(self, indices):
+        """
+        Whether the frames of samples are still in the frame store
+        Args:
+            indices: int or np.ndarray of sample indices
+
+        Returns: bool or np.ndarray of bool
+        """
+        if self.frames is None:
+            return np.ones(shape=np.shape(indices), dtype=bool)
+        oldest_frame = self.frames_written - self.frame_capacity
+        return np.all([self.columns[name][indices] >= oldest_frame for name in self.state_columns], axis=0)
+
+    def n_valid(self):
+        """
+        Amount of samples whose states can be gathered, the most recent ones
+        Returns: int
+        """
+        return self.n_added - max(self.first_valid, self.n_added - self.capacity)
+
+    def valid_indices(self):
+        """
+        Indices of the samples whose states can be gathered
+        Returns: np.ndarray of indices from old to new
+        """
+        return self.recent_indices(self.n_valid())
+
+    def get_states(self, name, indices, dtype=np.float32):
+        """
+        Gather layer boards
+        Args:
+            name: name of a state column
+            indices: sample indices
+            dtype: dtype of the returned layer boards
+
+        Returns: np.ndarray with shape (len(indices), 8, 8, 8)
+        """
+        if self.frames is None:
+            return unpack_states(self.columns[name][indices], dtype=dtype)
+        return unpack_states(self.frames[self.columns[name][indices] % self.frame_capacity], dtype=dtype)
+
+    def get_state_columns(self, names, indices, dtype=np.float32):
+        """
+        Gather the layer boards of several state columns. With a frame store, every frame is read from the store
+        once, also when it is the sucstate of one sample and the state of another.
+        Args:
+            names: names of state columns
+            indices: sample indices
+            dtype: dtype of the returned layer boards
+
+        Returns: list with an np.ndarray with shape (len(indices), 8, 8, 8) for every name
+        """
+        if self.frames is None:
+            return [self.get_states(name, indices, dtype=dtype) for name in names]
+        frame_numbers = np.stack([self.columns[name][indices] for name in names])
+        unique_frames, inverse = np.unique(frame_numbers, return_inverse=True)
+        frames = self.frames[unique_frames % self.frame_capacity][np.reshape(inverse, frame_numbers.shape)]
+        return [unpack_states(column_frames, dtype=dtype) for column_frames in frames]
+
+    def recent_indices(self, n_samples):
+        """
+        Indices of the most recent samples
+        Args:
+            n_samples: maximum amount of samples
+
+        Returns: np.ndarray of indices from old to new
+        """
+        n_samples = min(n_samples, self.size)
+        return (self.cursor - n_samples + np.arange(n_samples)) % self.capacity
+
+
+class SumTree(object):
+
+    def __init__(self, capacity, allocate=np.zeros):
+        """
+        Binary tree in an array where every node holds the sum of its children, for sampling proportional to
+        priority in O(log N). Leaf i is at position n_leaves + i, the root at position 1.
+        Args:
+            capacity: int
+                Amount of leaves that are used
+            allocate: function that returns a zero filled float64 array of a given shape
+        """
+        self.n_leaves = 1 << max(int(capacity - 1).bit_length(), 0)
+        self.depth = self.n_leaves.bit_length() - 1
+        self.tree = allocate((2 * self.n_leaves,))
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.n_leaves + np.asarray(indices)]
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of leaves and update their ancestors
+        Args:
+            indices: np.ndarray of leaf indices
+            priorities: np.ndarray of non-negative priorities
+
+        Returns:
+
+        """
+        nodes = self.n_leaves + np.asarray(indices)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        Find the leaves at cumulative priorities
+        Args:
+            values: np.ndarray of values in [0, total)
+
+        Returns: np.ndarray of leaf indices
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(shape=values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.n_leaves
+
+    def sample(self, n_samples):
+        """
+        Stratified sampling of leaves proportional to their priority
+        Args:
+            n_samples: int
+
+        Returns: np.ndarray of leaf indices
+        """
+        segment = self.total() / n_samples
+        values = (np.arange(n_samples) + np.random.rand(n_samples)) * segment
+        return self.find(np.minimum(values, np.nextafter(self.total(), 0)))
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+
+    def __init__(self, capacity, columns=None, state_columns=('state', 'sucstate'), state_dtype=np.int8,
+                 frame_capacity=None, alpha=0.6, beta=0.4, epsilon=1e-9):
+        """
+        Replay memory with prioritized sampling on a sum tree
+        Args:
+            capacity: int
+                Maximum amount of samples
+            columns: dict
+                Maps the name of each column to its dtype, or to a (dtype, shape) tuple for array valued samples
+            state_columns: tuple
+                Names of the columns that hold layer boards
+            state_dtype: storage dtype of the layer boards, see encoder.pack_states
+            frame_capacity: int
+                Amount of frames in the frame store, None stores the layer boards of every state column
+            alpha: float
+                Priority exponent, 0 samples uniformly
+            beta: float
+                Importance sampling exponent, 1 fully compensates the non-uniform sampling
+            epsilon: float
+                Added to the absolute errors so that every sample can be drawn
+        """
+        ReplayMemory.__init__(self, capacity, columns=columns, state_columns=state_columns, state_dtype=state_dtype,
+                              frame_capacity=frame_capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.priorities = SumTree(capacity, allocate=functools.partial(self.allocate, 'priorities'))
+        if self.n_added == 0:
+            self.max_priority = 1.
+
+    def add(self, priority=None, **sample):
+        """
+        Store a sample, overwriting the oldest sample if the memory is full
+        Args:
+            priority: float
+                Absolute error of the sample, None for the highest priority so far
+            **sample: a value for every column. States have shape (8, 8, 8) or (1, 8, 8, 8).
+
+        Returns: int
+            the index of the sample
+        """
+        index = ReplayMemory.add(self, **sample)
+        if priority is None:
+            self.priorities.update([index], [self.max_priority])
+        else:
+            self.update_priorities([index], [priority])
+        return index
+
+    def discard(self, index):
+        self.priorities.update([index], [0.])
+
+    def update_priorities(self, indices, errors):
+        """
+        Set the priorities of samples from their errors
+        Args:
+            indices: np.ndarray of sample indices
+            errors: np.ndarray of errors, e.g. TD errors
+
+        Returns:
+
+        """
+        priorities = (np.abs(errors) + self.epsilon) ** self.alpha
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+        self.priorities.update(indices, priorities)
+
+    def sample(self, batch_size, beta=None):
+        """
+        Sample proportional to priority
+        Args:
+            batch_size: int
+            beta: importance sampling exponent, None for self.beta
+
+        Returns:
+            indices: np.ndarray of sample indices
+            weights: np.ndarray of importance sampling weights, normalized to a maximum of 1
+        """
+        beta = self.beta if beta is None else beta
+        indices = self.priorities.sample(batch_size)
+        probabilities = self.priorities.get(indices) / self.priorities.total()
+        weights = (self.n_valid() * probabilities) ** -beta
+        return indices, weights / np.max(weights)
+
+
+class EpisodeReplayMemory(PrioritizedReplayMemory):
+
+    def __init__(self, capacity, columns=None, state_columns=('state', 'sucstate'), state_dtype=np.int8,
+                 frame_capacity=None, alpha=1., beta=0., epsilon=1e-9):
+        """
+        Prioritized replay memory for learners that update during an episode. The samples of the running episode
+        are stored with zero priority, so they are not drawn until end_episode gives them the highest priority.
+        Args:
+            capacity: int
+                Maximum amount of samples
+            columns: dict
+                Maps the name of each column to its dtype, or to a (dtype, shape) tuple for array valued samples
+            state_columns: tuple
+                Names of the columns that hold layer boards
+            state_dtype: storage dtype of the layer boards, see encoder.pack_states
+            frame_capacity: int
+                Amount of frames in the frame store, None stores the layer boards of every state column
+            alpha: float
+                Priority exponent, 1 samples proportional to the absolute error
+            beta: float
+                Importance sampling exponent
+            epsilon: float
+                Added to the absolute errors so that every sample can be drawn
+        """
+        PrioritizedReplayMemory.__init__(self, capacity, columns=columns, state_columns=state_columns,
+                                         state_dtype=state_dtype, frame_capacity=frame_capacity, alpha=alpha,
+                                         beta=beta, epsilon=epsilon)
+        self.episode_indices = []
+
+    def add(self, **sample):
+        """
+        Store a sample of the running episode, overwriting the oldest sample if the memory is full
+        Args:
+            **sample: a value for every column. States have shape (8, 8, 8) or (1, 8, 8, 8).
+
+        Returns: int
+            the index of the sample
+        """
+        index = ReplayMemory.add(self, **sample)
+        self.priorities.update([index], [0.])
+        self.episode_indices.append(index)
+        return index
+
+    def end_episode(self):
+        """
+        Make the samples of the finished episode available for sampling
+        Returns:
+
+        """
+        if self.episode_indices:
+            indices = np.unique(self.episode_indices)
+            indices = indices[self.is_valid(indices)]
+            self.priorities.update(indices, np.full(len(indices), self.max_priority))
+        self.episode_indices = []
+
+    def n_available(self):
+        """
+        Amount of samples that can be drawn
+        Returns: int
+        """
+        return max(self.n_valid() - len(set(self.episode_indices)), 0)
+
+
+class ShardedColumn(object):
+
+    def __init__(self, shards, shard_size, length=None):
+        """
+        Column that is split in shards of shard_size rows, e.g. memory mapped files. Indexing with an integer or
+        an index array gathers the rows shard by shard, so only the touched rows are read.
+        Args:
+            shards: list of np.ndarray or np.memmap
+            shard_size: int
+                Amount of rows of every shard except the last
+            length: amount of rows that are visible, None for all rows
+        """
+        self.shards = shards
+        self.shard_size = shard_size
+        self.length = sum(len(shard) for shard in shards) if length is None else length
+        self.dtype = shards[0].dtype
+        self.shape = (self.length,) + shards[0].shape[1:]
+
+    def __len__(self):
+        return self.length
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[np.arange(self.length)]
+        return values if dtype is None else values.astype(dtype)
+
+    def locate(self, key):
+        """
+        Shards and offsets of rows
+        Args:
+            key: int, index array or slice
+
+        Returns: tuple of np.ndarray
+            shard and offset of every row
+        """
+        if isinstance(key, slice):
+            key = np.arange(self.length)[key]
+        indices = np.asarray(key)
+        indices = np.where(indices < 0, indices + self.length, indices)
+        return np.divmod(indices, self.shard_size)
+
+    def __getitem__(self, key):
+        """
+        Read rows. A slice from the first row returns a ShardedColumn view, other keys return a copy.
+        Args:
+            key: int, index array or slice
+
+        Returns: ShardedColumn or np.ndarray
+        """
+        if isinstance(key, slice) and key.start in (None, 0) and key.step in (None, 1):
+            return ShardedColumn(self.shards, self.shard_size, length=len(range(self.length)[key]))
+        shard, offset = self.locate(key)
+        if shard.ndim == 0:
+            return self.shards[shard][offset]
+        values = np.empty(shape=shard.shape + self.shape[1:], dtype=self.dtype)
+        for k in np.unique(shard):
+            rows = shard == k
+            values[rows] = self.shards[k][offset[rows]]
+        return values
+
+    def __setitem__(self, key, values):
+        shard, offset = self.locate(key)
+        if shard.ndim == 0:
+            self.shards[shard][offset] = values
+            return
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), shard.shape + self.shape[1:])
+        for k in np.unique(shard):
+            rows = shard == k
+            self.shards[k][offset[rows]] = values[rows]
+
+
+class MemmapReplayMemory(PrioritizedReplayMemory):
+
+    def __init__(self, path, capacity=None, columns=None, state_columns=('state', 'sucstate'), state_dtype=np.int8,
+                 frame_capacity=None, shard_size=65536, alpha=0.6, beta=0.4, epsilon=1e-9):
+        """
+        Prioritized replay memory in memory mapped NumPy files, so the capacity can exceed the RAM and a memory can
+        be reopened by a later run. The directory holds layout.json with the layout version and the column layout,
+        index.npy with the counters of the memory, priorities.npy with the sum tree, and the columns and frames in
+        shards <column>.<shard>.npy of shard_size rows. If path holds a memory, it is reopened and capacity, columns,
+        state_columns, state_dtype, frame_capacity and shard_size are read from its layout.
+        Args:
+            path: str
+                Directory of the memory
+            capacity: int
+                Maximum amount of samples of a new memory
+            columns: dict
+                Maps the name of each column to its dtype, or to a (dtype, shape) tuple for array valued samples
+            state_columns: tuple
+                Names of the columns that hold layer boards
+            state_dtype: storage dtype of the layer boards, see encoder.pack_states
+            frame_capacity: int
+                Amount of frames in the frame store, None stores the layer boards of every state column
+            shard_size: int
+                Amount of rows per file
+            alpha: float
+                Priority exponent, 0 samples uniformly
+            beta: float
+                Importance sampling exponent, 1 fully compensates the non-uniform sampling
+            epsilon: float
+                Added to the absolute errors so that every sample can be drawn
+        """
+        self.path = path
+        self.memmaps = []
+        layout_file = os.path.join(path, 'layout.json')
+        self.reopened = os.path.exists(layout_file)
+        if self.reopened:
+            with open(layout_file) as f:
+                layout = json.load(f)
+            if layout.get('version', 0) != layout_version:
+                raise ValueError("The memory in " + path + " has layout version " + str(layout.get('version', 0)) +
+                                 ", but this version of RLC reads layout version " + str(layout_version) +
+                                 ". Replay memories are not migrated, start a new one in an empty directory.")
+            if capacity is not None and capacity != layout['capacity']:
+                raise ValueError("The memory in " + path + " has capacity " + str(layout['capacity']))
+            capacity = layout['capacity']
+            shard_size = layout['shard_size']
+            columns = {name: (np.dtype(dtype), tuple(shape)) for name, (dtype, shape) in layout['columns'].items()}
+            state_columns = tuple(layout['state_columns'])
+            state_dtype = np.dtype(layout['state_dtype'])
+            frame_capacity = layout['frame_capacity']
+        elif capacity is None:
+            raise ValueError("A new replay memory needs a capacity")
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.shard_size = shard_size
+        PrioritizedReplayMemory.__init__(self, capacity, columns=columns, state_columns=state_columns,
+                                         state_dtype=state_dtype, frame_capacity=frame_capacity, alpha=alpha,
+                                         beta=beta, epsilon=epsilon)
+        if not self.reopened:
+            layout = {'version': layout_version, 'capacity': capacity, 'shard_size': shard_size, 'columns': {},
+                      'state_columns': list(state_columns), 'state_dtype': np.dtype(state_dtype).str,
+                      'frame_capacity': frame_capacity}
+            for name, dtype in (columns or {}).items():
+                dtype, shape = dtype if isinstance(dtype, tuple) else (dtype, ())
+                layout['columns'][name] = (np.dtype(dtype).str, list(shape))
+            with open(layout_file, 'w') as f:
+                json.dump(layout, f)
+
+    def allocate(self, name, shape, dtype=np.float64):
+        """
+        Open the memory mapped file of an array, creating a zero filled file if it does not exist
+        Args:
+            name: name of the array
+            shape: tuple
+            dtype: numpy dtype
+
+        Returns: np.memmap
+        """
+        filename = os.path.join(self.path, name + '.npy')
+        if os.path.exists(filename):
+            array = np.lib.format.open_memmap(filename, mode='r+')
+            if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+                raise ValueError("The layout of " + filename + " does not match the memory")
+        else:
+            array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(shape))
+        self.memmaps.append(array)
+        return array
+
+    def allocate_column(self, name, shape, dtype):
+        shards = [self.allocate('%s.%04d' % (name, k), (min(self.shard_size, shape[0] - start),) + shape[1:], dtype)
+                  for k, start in enumerate(range(0, shape[0], self.shard_size))]
+        return ShardedColumn(shards, self.shard_size)
+
+    def flush(self):
+        """
+        Write the changes of all files to disk
+        Returns:
+
+        """
+        for array in self.memmaps:
+            array.flush()
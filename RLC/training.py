@@ -0,0 +1,68 @@
+import numpy as np
+
+
+def update_fixed_weights(fixed_model, model, tau=1):
+    """
+    Update the weights of a fixed (target) model in place
+    Args:
+        fixed_model: keras model with the same architecture as model
+        model: keras model
+        tau: float (0,1]
+            1 copies the weights, smaller values move the fixed weights a fraction tau towards the model weights
+
+    Returns:
+
+    """
+    if tau == 1:
+        fixed_model.set_weights(model.get_weights())
+    else:
+        fixed_model.set_weights([tau * w + (1 - tau) * fixed_w
+                                 for w, fixed_w in zip(model.get_weights(), fixed_model.get_weights())])
+
+
+def make_train_step(model, optimizer):
+    """
+    Create a fused training step for a value network: forward pass, weighted squared error loss, gradients and
+    weight update in one compiled TensorFlow function. Other Keras backends fall back to predict_on_batch and
+    train_on_batch of the compiled model.
+    Args:
+        model: keras model with a single output value per state, compiled with a mean squared error loss
+        optimizer: keras optimizer of the model
+
+    Returns: function(states, targets, sample_weights) -> np.ndarray
+        the per-sample errors target - value of an inference mode forward pass, before the update
+    """
+    import keras
+
+    if keras.backend.backend() != 'tensorflow':
+        def fallback_step(states, targets, sample_weights=None):
+            errors = np.asarray(targets) - np.reshape(model.predict_on_batch(states), -1)
+            model.train_on_batch(states, targets, sample_weight=sample_weights)
+            return errors
+
+        return fallback_step
+
+    import tensorflow as tf
+
+    if not optimizer.built:
+        optimizer.build(model.trainable_variables)
+
+    @tf.function(reduce_retracing=True)
+    def fused_step(states, targets, sample_weights):
+        # The errors become replay priorities, so they come from a forward pass without dropout noise
+        errors = targets - tf.reshape(model(states, training=False), [-1])
+        with tf.GradientTape() as tape:
+            values = tf.reshape(model(states, training=True), [-1])
+            loss = tf.reduce_mean(sample_weights * tf.square(targets - values))
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return errors
+
+    def train_step(states, targets, sample_weights=None):
+        targets = np.asarray(targets, dtype=np.float32)
+        if sample_weights is None:
+            sample_weights = np.ones_like(targets)
+        return fused_step(np.asarray(states, dtype=np.float32), targets,
+                          np.asarray(sample_weights, dtype=np.float32)).numpy()
+
+    return train_step
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from RLC.inference import NumpyModel
+from RLC.real_chess import agent
+from RLC.real_chess.broker import InferenceBroker
+from test.test_inference import get_states
+
+
+def test_broker_threads():
+    player = agent.Agent(network='super_simple')
+    evaluator = NumpyModel(player.model)
+    states = get_states()
+    results = [None] * len(states)
+
+    def worker(n, broker, barrier):
+        barrier.wait()
+        results[n] = broker.submit(states[n]).result()
+
+    with InferenceBroker(evaluator, max_batch_size=8, max_wait=0.05) as broker:
+        barrier = threading.Barrier(len(states))
+        threads = [threading.Thread(target=worker, args=(n, broker, barrier)) for n in range(len(states))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert np.allclose(broker.predict_on_batch(states), evaluator.predict(states))
+        stats = broker.stats()
+
+    assert np.allclose(np.concatenate(results), evaluator.predict(states))
+    assert stats['requests'] == len(states) + 1
+    assert max(stats['batch_size_histogram']) == len(states)  # The batch request is not split
+    assert max(size for size in stats['batch_size_histogram'] if size != len(states)) <= 8
+    assert stats['mean_batch_size'] > 1
+    assert stats['queue_depth'] == 0
+    assert 0 < stats['latency_percentiles'][50] <= stats['latency_percentiles'][99]
+
+
+def test_broker_async():
+    player = agent.Agent(network='super_simple')
+    evaluator = NumpyModel(player.model)
+    states = get_states()
+
+    async def evaluate(broker):
+        return await asyncio.gather(*[broker.submit_async(state) for state in states])
+
+    with InferenceBroker(evaluator, max_batch_size=64, max_wait=0.01) as broker:
+        values = asyncio.run(evaluate(broker))
+    assert np.allclose(np.concatenate(values), evaluator.predict(states))
+    assert broker.stats()['batches'] < len(states)
+
+
+def test_broker_not_started():
+    broker = InferenceBroker(NumpyModel(agent.Agent(network='super_simple').model))
+    with pytest.raises(RuntimeError):
+        broker.predict_on_batch(get_states())
+    with broker:
+        broker.predict_on_batch(get_states())
+    with pytest.raises(RuntimeError):
+        broker.submit(get_states())
@@ -0,0 +1,77 @@
+import numpy as np
+
+from RLC.real_chess import agent, environment, learn, tree
+from RLC.encoder import get_position_key
+from RLC.real_chess.cache import ValueCache
+from test.test_environment import random_games
+
+
+class CountingModel(object):
+
+    def __init__(self):
+        self.n_states = 0
+
+    def predict_on_batch(self, states):
+        self.n_states += len(states)
+        return np.sum(states[:, :6], axis=(1, 2, 3))[:, None]
+
+
+def test_lru_and_version():
+    cache = ValueCache(maxsize=2)
+    cache.put('a', 1.)
+    cache.put('b', 2.)
+    assert cache.get('a') == 1.
+    cache.put('c', 3.)  # Evicts the least recently used key b
+    assert cache.get('b') is None and cache.get('c') == 3. and len(cache) == 2
+    cache.set_version(1)
+    assert cache.get('a') is None and cache.get('c') is None
+    assert cache.hits == 2 and cache.misses == 3 and cache.hit_rate() == 0.4
+
+
+def test_evaluate():
+    model = CountingModel()
+    cache = ValueCache()
+    env = environment.Board(None)
+    successors = env.encode_successors(keys=True)
+    values = cache.evaluate(model, successors.states, successors.keys)
+    assert np.array_equal(values, np.reshape(model.predict_on_batch(successors.states), -1))
+    assert model.n_states == 2 * len(successors.states)
+    assert np.array_equal(cache.evaluate(model, successors.states, successors.keys), values)
+    assert model.n_states == 2 * len(successors.states) and cache.hits == len(successors.states)
+
+
+def test_position_keys():
+    for env in random_games(n_games=1, maxiter=60):
+        successors = env.encode_successors(keys=True)
+        for move, key in zip(successors.moves, successors.keys):
+            env.step(move)
+            assert key == get_position_key(env.board)
+            env.unstep()
+
+
+def test_simulate_with_cache():
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    assert not player.fixed_evaluator.stochastic
+    env = environment.Board(agent.GreedyAgent())
+    learner = learn.TD_search(env, player, search_time=0)
+    learner.min_sim_count = 20
+    node = learner.mcts(tree.Node(env.board))
+    assert env.board.fen() == environment.chess.STARTING_FEN
+    assert learner.value_cache.hits > 0 and len(learner.value_cache) > 0
+    version = player.fixed_version
+    player.fix_model()
+    assert player.fixed_version == version + 1
+    learner.mcts(node)
+    assert learner.value_cache.version == player.fixed_version
+
+
+def test_no_cache_for_stochastic_evaluator():
+    player = agent.Agent(network='default')
+    player.fix_model()
+    assert player.fixed_evaluator.stochastic
+    env = environment.Board(agent.GreedyAgent())
+    learner = learn.TD_search(env, player, search_time=0)
+    learner.min_sim_count = 5
+    learner.mcts(tree.Node(env.board))
+    assert len(learner.value_cache) == 0 and learner.value_cache.hits == 0
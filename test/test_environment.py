@@ -0,0 +1,174 @@
+import pickle
+
+import chess
+import numpy as np
+
+from RLC.real_chess import environment
+from RLC.capture_chess import environment as capture_environment
+from RLC.encoder import encode_board, encode_boards, get_legal_actions, get_legal_actions_batch, get_material_balance, \
+    mapper, material_values, pack_states, project_legal_actions, unpack_states
+
+FENS = [None,
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1"]
+
+
+def random_games(n_games=5, maxiter=100, seed=0):
+    """
+    Yield environments while random games are played in them
+    """
+    rng = np.random.RandomState(seed)
+    for fen in FENS:
+        for game in range(n_games):
+            env = environment.Board(None, FEN=fen)
+            for t in range(maxiter):
+                moves = list(env.board.generate_legal_moves())
+                if not moves:
+                    break
+                env.step(moves[rng.randint(len(moves))])
+                yield env
+
+
+def reference_layer_board(board):
+    """
+    Square by square encoding of the real chess environment
+    """
+    layer_board = np.zeros(shape=(8, 8, 8))
+    for i in range(64):
+        piece = board.piece_at(i)
+        if piece is not None:
+            layer_board[mapper[piece.symbol()], i // 8, i % 8] = 1 if piece.color else -1
+    layer_board[6, :, :] = 1 / board.fullmove_number
+    layer_board[6, 0, :] = 1 if board.turn else -1
+    layer_board[7, :, :] = 1
+    return layer_board
+
+
+def test_encode_boards():
+    boards = [env.board.copy() for env in random_games(n_games=1, maxiter=30)]
+    layer_boards = encode_boards(boards)
+    for board, layer_board in zip(boards, layer_boards):
+        assert np.array_equal(layer_board, reference_layer_board(board))
+        assert np.array_equal(encode_board(board), layer_board)
+
+
+def test_incremental_layer_board():
+    for env in random_games():
+        assert np.array_equal(env.layer_board, reference_layer_board(env.board)), env.board.fen()
+
+
+def test_unstep():
+    for env in random_games(n_games=2, maxiter=40):
+        if len(env.board.move_stack) == 40:
+            while env.board.move_stack:
+                env.unstep()
+                assert np.array_equal(env.layer_board, reference_layer_board(env.board)), env.board.fen()
+                assert env.get_material_value() == get_material_balance(env.board)
+
+
+def test_encode_successors():
+    for env in random_games(n_games=1, maxiter=60):
+        successors = env.encode_successors()
+        for i, move in enumerate(successors.moves):
+            episode_end, reward = env.step(move)
+            assert np.array_equal(successors.states[i], env.layer_board)
+            assert np.isclose(successors.rewards[i], reward)
+            assert successors.terminal[i] == episode_end
+            env.unstep()
+
+
+def test_material_counter():
+    for env in random_games(n_games=3):
+        plane_sum = np.dot(np.sum(env.layer_board[:6], axis=(1, 2)), material_values)
+        assert env.get_material_value() == plane_sum
+    env = capture_environment.Board()
+    rng = np.random.RandomState(0)
+    for game in range(5):
+        env.reset()
+        episode_end = False
+        while not episode_end:
+            moves = list(env.board.generate_legal_moves())
+            episode_end, reward = env.step(moves[rng.randint(len(moves))])
+            plane_sum = np.dot(np.sum(env.layer_board[:6], axis=(1, 2)), material_values)
+            assert env.get_material_value() == plane_sum
+
+
+def test_fork_and_snapshot():
+    env = environment.Board(None, FEN=FENS[1])
+    env.step(list(env.board.generate_legal_moves())[0])
+    snapshot = pickle.loads(pickle.dumps(env.snapshot()))
+    forked = env.fork()
+    for move in list(forked.board.generate_legal_moves())[:5]:
+        forked.step(move)
+        forked.unstep()
+    forked.step(list(forked.board.generate_legal_moves())[0])
+    assert len(forked.board.move_stack) == 2 and len(env.board.move_stack) == 1
+    assert np.array_equal(env.layer_board, reference_layer_board(env.board))
+
+    forked.restore(snapshot)
+    assert forked.board.fen() == env.board.fen()
+    assert np.array_equal(forked.layer_board, env.layer_board)
+    forked.unstep()
+    assert forked.board.fen() == FENS[1]
+    assert np.array_equal(forked.layer_board, reference_layer_board(forked.board))
+    assert forked.get_material_value() == get_material_balance(forked.board)
+
+
+def test_pack_states():
+    states = np.stack([env.layer_board.copy() for env in random_games(n_games=1, maxiter=20)], axis=0)
+    packed = pack_states(states, dtype=np.int8)
+    assert packed.nbytes == 400 * len(states)
+    assert np.allclose(unpack_states(packed), states)
+    assert unpack_states(packed).dtype == np.float32
+    assert np.array_equal(unpack_states(pack_states(states, dtype=np.float32)), states.astype(np.float32))
+
+
+def test_vector_board():
+    vector_env = environment.VectorBoard(None, n_boards=3, FEN="7k/8/8/8/8/8/8/K6Q w - - 0 1")
+    states, action_spaces = vector_env.reset()
+    np.random.seed(0)
+    finished = 0
+    for t in range(50):
+        actions = [env.get_random_action() for env in vector_env.envs]
+        states, rewards, episode_ends, action_spaces = vector_env.step(actions)
+        assert states.shape == (3, 8, 8, 8) and action_spaces.shape == (3, 64, 64)
+        for env, state, episode_end in zip(vector_env.envs, states, episode_ends):
+            assert np.array_equal(state, reference_layer_board(env.board))
+            if episode_end:
+                finished += 1
+                assert len(env.board.move_stack) == 0
+    assert finished > 0
+
+
+def test_get_result():
+    for env in random_games(n_games=3, maxiter=300):
+        assert env.get_result() == env.board.result()
+        assert environment.get_result(env.board, draw_rules='basic') in ("*", env.board.result())
+    env = environment.Board(None, FEN="7k/8/8/8/8/8/8/K2Q4 w - - 0 1")
+    for move in ["a1b1", "h8g8", "b1a1", "g8h8"] * 2:
+        episode_end, reward = env.step(chess.Move.from_uci(move))
+    assert not episode_end and env.get_result() == "*"
+    assert environment.get_result(env.board, draw_rules='claim') == env.board.result(claim_draw=True) == "1/2-1/2"
+    # Claims that are made with the next move
+    repetition = chess.Board()
+    for move in ["g1f3", "g8f6", "f3g1", "f6g8", "g1f3", "g8f6", "f3g1"]:
+        repetition.push_uci(move)
+    fifty_moves = chess.Board("7k/8/8/8/8/8/8/K6Q w - - 99 80")
+    for board in [repetition, fifty_moves]:
+        assert environment.get_result(board) == "*"
+        assert environment.get_result(board, draw_rules='claim') == board.result(claim_draw=True) == "1/2-1/2"
+
+
+def test_legal_actions():
+    boards = [env.board.copy() for env in random_games(n_games=1, maxiter=40)]
+    board_ids, action_ids, moves = get_legal_actions_batch(boards)
+    action_spaces = project_legal_actions(action_ids, board_ids=board_ids, n_boards=len(boards))
+    for n, board in enumerate(boards):
+        legal_moves = list(board.generate_legal_moves())
+        action_space = np.zeros(shape=(64, 64))
+        for move in legal_moves:
+            action_space[move.from_square, move.to_square] = 1
+            assert moves[n][move.from_square * 64 + move.to_square] in legal_moves
+        assert np.array_equal(action_spaces[n], action_space)
+        assert np.array_equal(project_legal_actions(get_legal_actions(board)[0]), action_space)
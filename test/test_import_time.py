@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ['RLC.encoder', 'RLC.inference', 'RLC.training', 'RLC.replay',
+           'RLC.real_chess.environment', 'RLC.real_chess.agent', 'RLC.real_chess.tree', 'RLC.real_chess.learn',
+           'RLC.real_chess.cache', 'RLC.real_chess.broker',
+           'RLC.capture_chess.environment', 'RLC.capture_chess.agent', 'RLC.capture_chess.learn',
+           'RLC.move_chess.environment', 'RLC.move_chess.agent', 'RLC.move_chess.learn']
+HEAVY_MODULES = ['keras', 'tensorflow', 'pandas', 'matplotlib']
+
+SCRIPT = """
+import importlib, json, sys, time
+starttime = time.perf_counter()
+for module in {modules}:
+    importlib.import_module(module)
+print(json.dumps({{'seconds': time.perf_counter() - starttime,
+                   'heavy': [module for module in {heavy} if module in sys.modules]}}))
+"""
+
+
+def import_modules(modules):
+    """
+    Import modules in a fresh interpreter
+    Returns: dict with the import time in seconds and the heavy modules that were loaded
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', SCRIPT.format(modules=modules, heavy=HEAVY_MODULES)], cwd=root,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_no_heavy_imports():
+    for module in MODULES:
+        assert import_modules([module])['heavy'] == [], module
+
+
+def test_import_time():
+    import_modules(MODULES)  # Warm up the bytecode cache
+    benchmark = import_modules(MODULES)
+    assert benchmark['seconds'] < 2, "importing all RLC modules took " + str(round(benchmark['seconds'] * 1000)) + " ms"
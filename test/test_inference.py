@@ -0,0 +1,90 @@
+import numpy as np
+from keras.layers import Input, Conv2D, Dense, Flatten
+from keras.models import Model
+
+from RLC.inference import NumpyModel, QuantizedModel, accuracy_report
+from RLC.real_chess import agent, environment
+from RLC.capture_chess import agent as capture_agent
+from test.test_environment import random_games
+
+
+def get_states(n_states=16):
+    return np.stack([env.layer_board.copy() for env in random_games(n_games=1, maxiter=n_states // 4)], axis=0)
+
+
+def test_real_chess_networks():
+    states = get_states()
+    for network in ['simple', 'super_simple', 'alt', 'big', 'default']:
+        player = agent.Agent(network=network)
+        for layer in player.model.layers:
+            if type(layer).__name__ == 'Dropout':
+                layer.rate = 0  # Make the Monte Carlo dropout of the default network deterministic
+        evaluator = NumpyModel(player.model)
+        assert np.allclose(evaluator.predict(states), player.model.predict_on_batch(states), atol=1e-5), network
+
+
+def test_capture_chess_networks():
+    states = get_states()
+    legal_moves = np.random.RandomState(0).randint(0, 2, size=(len(states), 4096)).astype(np.float32)
+    for network in ['linear', 'conv', 'conv_pg']:
+        player = capture_agent.Agent(network=network)
+        inputs = [states, np.ones((len(states), 1)), legal_moves] if network == 'conv_pg' else states
+        evaluator = NumpyModel(player.model)
+        assert np.allclose(evaluator.predict(inputs), player.model.predict_on_batch(inputs), atol=1e-5), network
+
+
+def test_fixed_evaluator():
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    states = get_states()
+    assert np.allclose(player.fixed_evaluator.predict(states), player.fixed_model.predict_on_batch(states), atol=1e-5)
+    player.model.set_weights([w + 1 for w in player.model.get_weights()])
+    assert not np.allclose(player.fixed_evaluator.predict(states), player.model.predict_on_batch(states), atol=1e-5)
+    player.fix_model()
+    assert np.allclose(player.fixed_evaluator.predict(states), player.model.predict_on_batch(states), atol=1e-5)
+
+
+def test_monte_carlo_dropout():
+    player = agent.Agent(network='default')
+    evaluator = NumpyModel(player.model)
+    state = np.expand_dims(environment.Board(None).layer_board, axis=0)
+    predictions = np.array([evaluator.predict(state)[0, 0] for _ in range(20)])
+    assert np.std(predictions) > 0
+
+
+def test_predict_distribution():
+    player = agent.Agent(network='default')
+    states = get_states()
+    mean_pred, std_pred, upper_bound = player.predict_distribution(states, n_samples=40, batch_size=64)
+    assert mean_pred.shape == std_pred.shape == upper_bound.shape == (len(states),)
+    assert np.all(std_pred > 0)
+    assert np.allclose(upper_bound, mean_pred + 2 * std_pred)
+    many_states = np.repeat(states, 20, axis=0)
+    mean_pred, std_pred, upper_bound = player.predict_distribution(many_states)  # More states than batch_size
+    assert mean_pred.shape == (len(many_states),) and np.all(np.isfinite(mean_pred))
+
+
+def test_quantized_model():
+    states = get_states(n_states=64)
+    layer_state = Input(shape=(8, 8, 8))
+    conv = Conv2D(8, (3, 3), activation='relu')(layer_state)
+    dense = Dense(32, activation='relu')(Flatten()(conv))
+    model = Model(inputs=layer_state, outputs=Dense(1)(dense))
+    reference = NumpyModel(model)
+    for precision in ['float16', 'int8']:
+        quantized = QuantizedModel(model, precision=precision, calibration_states=states[::2])
+        report = accuracy_report(reference, quantized, states[1::2])
+        # The worst int8 relative error over 300 random initializations was 0.072
+        assert report['relative_error'] < 0.1 and report['correlation'] > 0.99, (precision, report)
+        kernel_bytes = sum(w.nbytes for w in model.get_weights() if w.ndim > 1)
+        assert quantized.nbytes() < kernel_bytes / (3.5 if precision == 'int8' else 1.9)
+
+
+def test_quantized_fixed_evaluator():
+    states = get_states(n_states=64)
+    player = agent.Agent(network='simple', inference_precision='int8')
+    player.fix_model()
+    assert type(player.fixed_evaluator) is NumpyModel and player.quantization_report is None
+    player.fix_model(calibration_states=states)
+    assert isinstance(player.fixed_evaluator, QuantizedModel)
+    assert player.quantization_report['max_abs_error'] < 0.01
@@ -0,0 +1,157 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from RLC.replay import EpisodeReplayMemory, MemmapReplayMemory, PrioritizedReplayMemory, ReplayMemory, SumTree, \
+    frame_capacity
+from test.test_environment import random_games
+
+
+def test_ring_buffer():
+    states = [env.layer_board.copy() for env in random_games(n_games=1, maxiter=10)]
+    for state_dtype in [np.int8, np.float32]:
+        memory = ReplayMemory(16, columns={'reward': np.float64}, state_columns=('state',), state_dtype=state_dtype)
+        for n, state in enumerate(states):
+            assert memory.add(state=state, reward=n) == n % 16
+        assert len(memory) == 16 and memory.cursor == len(states) % 16
+        recent = memory.recent_indices(20)
+        assert np.array_equal(memory['reward'][recent], np.arange(len(states) - 16, len(states)))
+        assert np.allclose(memory.get_states('state', recent), np.stack(states[-16:]))
+        memory['reward'][recent[-1]] = -1
+        assert memory.columns['reward'][recent[-1]] == -1
+
+
+def test_partially_filled():
+    memory = ReplayMemory(8, columns={'error': np.float64})
+    memory.add(state=np.zeros((1, 8, 8, 8)), sucstate=np.ones((8, 8, 8)), error=2.)
+    assert len(memory) == 1 and memory['error'].shape == (1,)
+    assert np.array_equal(memory.get_states('sucstate', memory.recent_indices(4)), np.ones((1, 8, 8, 8)))
+
+
+def test_sum_tree():
+    tree = SumTree(5)
+    priorities = np.array([1., 0., 3., 2., 4.])
+    tree.update(np.arange(5), priorities)
+    assert tree.total() == 10
+    assert np.array_equal(tree.find([0, 0.99, 1, 3.99, 4, 5.99, 6, 9.99]), [0, 0, 2, 2, 3, 3, 4, 4])
+    np.random.seed(0)
+    counts = np.bincount(np.concatenate([tree.sample(10) for _ in range(2000)]), minlength=5)
+    assert np.allclose(counts / counts.sum(), priorities / 10, atol=0.01)
+    tree.update([4, 4], [0., 0.])
+    assert tree.total() == 6
+
+
+def test_prioritized_replay():
+    memory = PrioritizedReplayMemory(4, columns={'reward': np.float64}, state_columns=(), alpha=1, beta=1,
+                                     epsilon=0)
+    for n in range(6):
+        memory.add(priority=n, reward=n)  # Samples 0 and 1 are overwritten by 4 and 5
+    assert memory.priorities.total() == 2 + 3 + 4 + 5
+    indices, weights = memory.sample(200)
+    assert set(memory['reward'][indices]) == {2, 3, 4, 5}
+    probabilities = memory['reward'][indices] / 14
+    assert np.allclose(weights, (1 / probabilities) / np.max(1 / probabilities))
+    memory.update_priorities([0, 1, 2, 3], [0, 0, 0, 1])
+    indices, weights = memory.sample(10)
+    assert np.all(indices == 3) and np.all(weights == 1)
+
+
+def test_episode_replay():
+    memory = EpisodeReplayMemory(4, columns={'reward': np.float64, 'legal_moves': (np.bool_, (16,))},
+                                 state_columns=())
+    assert memory.columns['legal_moves'].shape == (4, 16)
+    for n in range(3):
+        memory.add(reward=n, legal_moves=np.arange(16) == n)
+    assert memory.n_available() == 0 and memory.priorities.total() == 0
+    memory.end_episode()
+    assert memory.n_available() == 3
+    memory.add(reward=3, legal_moves=np.arange(16) == 3)
+    memory.add(reward=4, legal_moves=np.arange(16) == 4)  # Overwrites sample 0 of the finished episode
+    assert memory.n_available() == 2
+    indices, _ = memory.sample(100)
+    assert set(memory['reward'][indices]) == {1, 2}
+    assert np.array_equal(np.argmax(memory['legal_moves'][indices], axis=1), memory['reward'][indices])
+
+
+def test_memmap_replay(tmp_path):
+    boards = np.stack([env.layer_board.copy() for env in random_games(n_games=1, maxiter=10)])
+    n_samples = len(boards) - 1
+    path = str(tmp_path / 'replay')
+    memory = MemmapReplayMemory(path, 12, columns={'reward': np.float64}, shard_size=5)
+    assert [len(shard) for shard in memory.columns['state'].shards] == [5, 5, 2]
+    for n in range(n_samples):
+        memory.add(priority=n, state=boards[n], sucstate=boards[n + 1], reward=n)
+    recent = memory.recent_indices(12)
+    assert np.array_equal(memory['reward'][recent], np.arange(n_samples - 12, n_samples))
+    assert np.allclose(memory.get_states('sucstate', recent), boards[-12:])
+    memory['reward'][recent[:2]] = -1
+    memory.update_priorities(recent[-1:], [100])
+    memory.flush()
+    total, cursor = memory.priorities.total(), memory.cursor
+    del memory
+
+    memory = MemmapReplayMemory(path)
+    assert memory.reopened and len(memory) == 12 and memory.cursor == cursor
+    assert memory.priorities.total() == total and np.isclose(memory.max_priority, 100 ** 0.6)
+    assert np.array_equal(memory['reward'][recent], [-1, -1] + list(range(n_samples - 10, n_samples)))
+    assert np.allclose(memory.get_states('state', recent), boards[-13:-1])
+    assert np.array_equal(np.asarray(memory['reward']), memory['reward'][np.arange(12)])
+    del memory
+
+    layout_file = os.path.join(path, 'layout.json')
+    with open(layout_file) as f:
+        layout = json.load(f)
+    del layout['version']  # Memories written before the layout was versioned
+    with open(layout_file, 'w') as f:
+        json.dump(layout, f)
+    with pytest.raises(ValueError, match='layout version 0'):
+        MemmapReplayMemory(path)
+
+
+def play_games(n_games, n_moves):
+    """
+    Layer boards of random games, n_moves + 1 positions per game
+    """
+    games = []
+    for seed in range(n_games):
+        positions = [env.layer_board.copy() for env in random_games(n_games=1, maxiter=n_moves + 1, seed=seed)]
+        games.append(np.stack(positions[:n_moves + 1]))
+    return games
+
+
+def test_frame_store():
+    games = play_games(3, 5)
+    memory = ReplayMemory(15, columns={'episode_active': np.int8}, frame_capacity=frame_capacity(15, 5))
+    dense = ReplayMemory(15, columns={'episode_active': np.int8})
+    for game in games:
+        for t in range(5):
+            memory.add(sucstate=game[t + 1], episode_active=int(t < 4), state=game[t])  # Any keyword order
+            dense.add(state=game[t], sucstate=game[t + 1], episode_active=int(t < 4))
+    assert memory.frames_written == 3 * 6  # Every position once, including the first position of every game
+    assert np.array_equal(memory['sucstate'][:4], memory['state'][1:5])
+    assert memory['state'][5] == memory['sucstate'][4] + 1  # A new game starts with a new frame
+    indices = np.random.RandomState(0).randint(15, size=32)
+    for name in ['state', 'sucstate']:
+        assert np.array_equal(memory.get_states(name, indices), dense.get_states(name, indices))
+    for memory_states, dense_states in zip(memory.get_state_columns(['state', 'sucstate'], indices),
+                                           dense.get_state_columns(['state', 'sucstate'], indices)):
+        assert np.array_equal(memory_states, dense_states)
+    assert memory.frames.nbytes + memory.columns['state'].nbytes * 2 < 0.7 * dense.columns['state'].nbytes * 2
+
+
+def test_frame_store_invalidation():
+    games = play_games(4, 2)
+    memory = PrioritizedReplayMemory(6, columns={'reward': np.float64}, frame_capacity=7, alpha=1, beta=0,
+                                     epsilon=0)
+    for n, game in enumerate(games):
+        for t in range(2):
+            memory.add(priority=1, state=game[t], sucstate=game[t + 1], reward=2 * n + t)
+    # 12 frames were written, the last 7 hold the last position of game 1 and the positions of games 2 and 3
+    assert len(memory) == 6 and memory.n_valid() == 4
+    assert np.array_equal(memory['reward'][memory.valid_indices()], [4, 5, 6, 7])
+    assert memory.priorities.total() == 4
+    indices, _ = memory.sample(50)
+    assert set(memory['reward'][indices]) == {4, 5, 6, 7}
+    assert np.allclose(memory.get_states('state', memory.valid_indices()), np.concatenate([games[2][:2], games[3][:2]]))
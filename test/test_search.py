@@ -0,0 +1,93 @@
+import numpy as np
+
+from RLC.real_chess import agent, environment, learn, tree
+from RLC.replay import MemmapReplayMemory, frame_capacity
+
+
+def test_evaluate_successors():
+    player = agent.Agent(network='super_simple')
+    env = environment.Board(agent.GreedyAgent(), FEN="6k1/5ppp/8/8/8/8/8/K3R3 w - - 0 1")
+    successors = env.encode_successors()
+    values = tree.evaluate_successors(player.model, successors, gamma=0.8)
+    assert np.any(successors.terminal)
+    for move, value in zip(successors.moves, values):
+        episode_end, reward = env.step(move)
+        if episode_end:
+            expected = reward
+        else:
+            expected = reward + 0.8 * np.squeeze(player.model.predict_on_batch(np.expand_dims(env.layer_board, 0)))
+        env.unstep()
+        assert np.isclose(value, expected, atol=1e-6)
+
+
+def test_simulate_plays_immediate_win():
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    env = environment.Board(agent.GreedyAgent(), FEN="6k1/5ppp/8/8/8/8/8/K3R3 w - - 0 1")
+    node = tree.Node(env.board)
+    for t in range(5):
+        Returns, move = node.simulate(player.fixed_model, env)
+        assert Returns == 1 and move.uci() == "e1e8"
+        assert env.board.fen() == "6k1/5ppp/8/8/8/8/8/K3R3 w - - 0 1"
+
+
+def test_mcts():
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    env = environment.Board(agent.GreedyAgent())
+    learner = learn.TD_search(env, player, search_time=0)
+    root = learner.mcts(tree.Node(env.board))
+    assert len(root.children) == 20
+    assert all(len(child.values) >= 1 for child in root.children.values())
+    assert env.board.fen() == environment.chess.STARTING_FEN
+
+
+def test_opponent_batch():
+    env = environment.Board(None, FEN="r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+    successors = env.encode_successors()
+    greedy = agent.GreedyAgent()
+    values = greedy.predict(successors.states, noise=False)
+    assert values.shape == (len(successors.moves),)
+    for move, value in zip(successors.moves, values):
+        env.step(move)
+        assert value == greedy.evaluate_material(env.get_material_value(), noise=False)
+        assert greedy.predict(np.expand_dims(env.layer_board, axis=0), noise=False) == value
+        env.unstep()
+    assert np.all(np.abs(greedy.predict(successors.states) - values) < 0.01)
+    random_values = agent.RandomAgent().predict(successors.states)
+    assert random_values.shape == values.shape and np.all(np.abs(random_values) <= 1)
+
+
+def test_play_game():
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    env = environment.Board(agent.GreedyAgent())
+    learner = learn.TD_search(env, player, search_time=0, memsize=8, batch_size=4)
+    learner.min_sim_count = 2
+    learner.ready = True
+    learner.play_game(0, maxiter=12)
+    n_moves = len(learner.reward_trace)  # The game can end before maxiter
+    assert 0 < n_moves <= 13 and len(learner.memory) == min(n_moves, 8)
+    assert learner.get_recent_states(4).shape == (min(n_moves, 4), 8, 8, 8)
+
+
+def test_play_game_memmap(tmp_path):
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    env = environment.Board(agent.GreedyAgent())
+    memory = MemmapReplayMemory(str(tmp_path), 8, columns=learn.transition_columns, frame_capacity=frame_capacity(8),
+                                alpha=1, beta=0)
+    learner = learn.TD_search(env, player, search_time=0, batch_size=4, memory=memory)
+    learner.min_sim_count = 2
+    learner.ready = True
+    learner.play_game(0, maxiter=12)
+    n_moves = len(learner.reward_trace)  # The game can end before maxiter
+    assert learner.memory is memory and len(memory) == min(n_moves, 8)
+    assert memory.frames_written == n_moves + 1  # One frame per position of the game
+    states = learner.get_recent_states(4)
+    assert states.shape == (min(n_moves, 4), 8, 8, 8)
+    memory.flush()
+    reopened = MemmapReplayMemory(str(tmp_path))
+    assert reopened.frames_written == n_moves + 1 and reopened.frame_capacity == frame_capacity(8)
+    assert np.array_equal(reopened.get_states('sucstate', reopened.valid_indices()),
+                          memory.get_states('sucstate', memory.valid_indices()))
@@ -0,0 +1,99 @@
+import numpy as np
+
+from RLC.real_chess import agent
+from RLC.capture_chess import agent as capture_agent
+from RLC.capture_chess import environment as capture_environment
+from RLC.capture_chess import learn as capture_learn
+
+
+def shift_weights(model, delta):
+    model.set_weights([w + delta for w in model.get_weights()])
+
+
+def test_fix_model_in_place():
+    for player in [agent.Agent(network='super_simple'), capture_agent.Agent(network='conv')]:
+        player.fix_model()
+        fixed_model = player.fixed_model
+        shift_weights(player.model, 1)
+        player.fix_model()
+        assert player.fixed_model is fixed_model and player.fixed_version == 2
+        for w, fixed_w in zip(player.model.get_weights(), player.fixed_model.get_weights()):
+            assert np.array_equal(w, fixed_w)
+
+
+def test_polyak_update():
+    player = agent.Agent(network='super_simple', tau=0.25)
+    player.fix_model()
+    before = player.fixed_model.get_weights()
+    shift_weights(player.model, 1)
+    player.fix_model()
+    for w, fixed_w in zip(before, player.fixed_model.get_weights()):
+        assert np.allclose(fixed_w, w + 0.25, atol=1e-6)
+    states = np.random.RandomState(0).randint(-1, 2, size=(4, 8, 8, 8)).astype(np.float32)
+    assert np.allclose(player.fixed_evaluator.predict(states), player.fixed_model.predict_on_batch(states), atol=1e-5)
+
+
+def test_td_update():
+    rng = np.random.RandomState(0)
+    states = rng.randint(-1, 2, size=(64, 8, 8, 8)).astype(np.float32)
+    sucstates = rng.randint(-1, 2, size=(64, 8, 8, 8)).astype(np.float32)
+    rewards = rng.randn(64)
+    episode_active = rng.randint(0, 2, size=64)
+    player = agent.Agent(network='super_simple')
+    player.fix_model()
+    targets = rewards + episode_active * 0.9 * np.reshape(player.fixed_model.predict_on_batch(sucstates), -1)
+    values = np.reshape(player.model.predict_on_batch(states), -1)
+    td_errors = player.TD_update(states, rewards, sucstates, episode_active, gamma=0.9, batch_size=64)
+    assert td_errors.shape == (64,)
+    assert np.allclose(td_errors, targets - values, atol=1e-4)
+    for _ in range(20):
+        player.TD_update(states, rewards, sucstates, episode_active, gamma=0.9)
+    new_values = np.reshape(player.model.predict_on_batch(states), -1)
+    assert np.mean((targets - new_values) ** 2) < np.mean((targets - values) ** 2)
+
+
+def test_train_errors_in_inference_mode():
+    rng = np.random.RandomState(0)
+    states = rng.randint(-1, 2, size=(40, 8, 8, 8)).astype(np.float32)
+    returns = rng.randn(40)
+    player = agent.Agent(network='default', learning_rate=0.)  # Dropout, but constant weights
+    values = np.reshape(player.model.predict_on_batch(states), -1)
+    errors = player.MC_update(states, returns, batch_size=16)
+    assert np.allclose(errors, returns - values, atol=1e-4)
+
+def test_train_step_fallback(monkeypatch):
+    import keras
+
+    monkeypatch.setattr(keras.backend, 'backend', lambda: 'jax')
+    rng = np.random.RandomState(0)
+    states = rng.randint(-1, 2, size=(16, 8, 8, 8)).astype(np.float32)
+    returns = rng.randn(16)
+    player = agent.Agent(network='super_simple')
+    values = np.reshape(player.model.predict_on_batch(states), -1)
+    before = player.model.get_weights()
+    errors = player.MC_update(states, returns, batch_size=16)
+    assert np.allclose(errors, returns - values, atol=1e-4)
+    assert any(not np.array_equal(w, w_after) for w, w_after in zip(before, player.model.get_weights()))
+
+def test_mc_update_trains():
+    rng = np.random.RandomState(0)
+    states = rng.randint(-1, 2, size=(40, 8, 8, 8)).astype(np.float32)
+    returns = rng.randn(40)
+    player = agent.Agent(network='super_simple')
+    before = player.model.get_weights()
+    errors = player.MC_update(states, returns, sample_weights=np.linspace(0, 1, 40))
+    assert errors.shape == (40,)
+    assert any(not np.array_equal(w, w_after) for w, w_after in zip(before, player.model.get_weights()))
+
+
+def test_capture_q_learning():
+    env = capture_environment.Board()
+    learner = capture_learn.Q_learning(capture_agent.Agent(network='conv'), env, memsize=16)
+    learner.agent.fix_model()
+    for k in range(3):
+        env.reset()
+        learner.play_game(k, maxiter=6)
+    assert len(learner.memory) == 16 and learner.memory.n_available() == 16
+    minibatch = capture_learn.get_minibatch(learner.memory, np.arange(4))
+    assert minibatch['states'].shape == minibatch['new_states'].shape == (4, 8, 8, 8)
+    assert minibatch['moves'].shape == (4, 2)